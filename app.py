@@ -3,6 +3,7 @@ MyTrainingOS - TrainingPeaks-like Dashboard
 Versione semplificata e funzionante
 """
 
+import io
 import streamlit as st
 import pandas as pd
 import numpy as np
@@ -10,59 +11,306 @@ import plotly.graph_objects as go
 from datetime import datetime, timedelta
 from pathlib import Path
 
+# Numba opzionale: senza JIT il loop resta in Python puro
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 st.set_page_config(layout="wide", page_title="MyTrainingOS", page_icon="🏃")
 
 # ============================================================================
 # FUNZIONI
 # ============================================================================
 
-def load_excel_data(file_path):
-    """Carica il file Excel, ritorna dati deduplucati e dati lap grezzi"""
-    df_raw = pd.read_excel(file_path)
+@st.cache_data(show_spinner=False)
+def load_excel_data(file_bytes):
+    """Carica il file Excel, ritorna dati deduplucati e dati lap grezzi.
+    Riceve i byte del file così la cache è legata al contenuto, non al percorso."""
+    df_raw = pd.read_excel(io.BytesIO(file_bytes))
     # Deduplica: una riga per activity (per calcoli PMC)
     df = df_raw.groupby('ActivityID').first().reset_index()
     return df, df_raw
 
-def calculate_sport_tss(row, ftp, lthr):
-    """Calcola TSS sport-specific"""
-    duration_h = row['Attivita_Durata Totale (sec)'] / 3600 if pd.notna(row['Attivita_Durata Totale (sec)']) else 0
-    sport = str(row['Attivita_Tipo Sport']).lower() if pd.notna(row['Attivita_Tipo Sport']) else ''
-    
-    # CYCLING con potenza
-    if 'cycl' in sport:
-        np_val = row['Attivita_Potenza Normalizzata (W)']
-        if pd.notna(np_val) and np_val > 0 and ftp > 0:
-            intensity_factor = np_val / ftp
-            return (row['Attivita_Durata Totale (sec)'] * np_val * intensity_factor) / (ftp * 36)
+def calculate_sport_tss(df, ftp, lthr):
+    """Calcola TSS sport-specific per tutte le attività in un solo passaggio vettoriale"""
+    # Colonne numeriche coerce una volta sola: valori mancanti/non numerici diventano NaN
+    dur, np_arr, hr = (
+        pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=np.float64)
+        for c in ['Attivita_Durata Totale (sec)', 'Attivita_Potenza Normalizzata (W)', 'Attivita_FC Media (bpm)']
+    )
     
-    # RUNNING: rTSS quadratico
-    if 'run' in sport:
-        hr = row['Attivita_FC Media (bpm)']
-        if pd.notna(hr) and hr > 0 and lthr > 0:
-            return duration_h * ((hr / lthr) ** 2) * 100
-        return duration_h * 70
+    duration_h = np.where(np.isnan(dur), 0, dur / 3600)
     
-    # SWIMMING: sTSS cubico
-    if 'swim' in sport:
-        hr = row['Attivita_FC Media (bpm)']
-        if pd.notna(hr) and hr > 0 and lthr > 0:
-            return duration_h * ((hr / lthr) ** 3) * 100
-        return duration_h * 50
+    is_cycl = df['_is_cycl'].to_numpy()
+    is_run = df['_is_run'].to_numpy()
+    is_swim = df['_is_swim'].to_numpy()
     
-    # ALTRI sport: HR generico
-    hr = row['Attivita_FC Media (bpm)']
-    if pd.notna(hr) and hr > 0 and lthr > 0:
-        return duration_h * ((hr / lthr) ** 2) * 100
+    valid_np = ~np.isnan(np_arr) & (np_arr > 0) & (ftp > 0)
+    valid_hr = ~np.isnan(hr) & (hr > 0) & (lthr > 0)
     
-    return duration_h * 60
+    # Stesso ordine dei rami originali: ciclismo con potenza, corsa, nuoto, altri sport
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hr_ratio = hr / lthr
+        conditions = [
+            is_cycl & valid_np,             # CYCLING con potenza
+            is_run & valid_hr,              # RUNNING: rTSS quadratico
+            is_run,
+            is_swim & valid_hr,             # SWIMMING: sTSS cubico
+            is_swim,
+            valid_hr,                       # ALTRI sport: HR generico
+        ]
+        choices = [
+            dur * np_arr * np_arr / (ftp * ftp * 36),
+            duration_h * hr_ratio ** 2 * 100,
+            duration_h * 70,
+            duration_h * hr_ratio ** 3 * 100,
+            duration_h * 50,
+            duration_h * hr_ratio ** 2 * 100,
+        ]
+        return np.select(conditions, choices, default=duration_h * 60)
+
+@njit(cache=True)
+def ewm_recursive(x, alpha):
+    """Media esponenziale ricorsiva, equivalente a ewm(adjust=False).mean()"""
+    out = np.empty_like(x)
+    if len(x) == 0:
+        return out
+    out[0] = x[0]
+    for i in range(1, len(x)):
+        out[i] = alpha * x[i] + (1 - alpha) * out[i - 1]
+    return out
 
 def calculate_pmc(daily_tss_series):
     """Calcola CTL, ATL, TSB da serie giornaliera"""
-    ctl = daily_tss_series.ewm(span=42, adjust=False).mean()
-    atl = daily_tss_series.ewm(span=7, adjust=False).mean()
+    tss = daily_tss_series.to_numpy(dtype=np.float64)
+    ctl = ewm_recursive(tss, 2 / (42 + 1))
+    atl = ewm_recursive(tss, 2 / (7 + 1))
     tsb = ctl - atl
     return ctl, atl, tsb
 
+def format_lap_details(laps, sport):
+    """Formatta i lap di un'attività lavorando per colonne invece che riga per riga"""
+    nums = laps['Numero Lap'].fillna(0).to_numpy(dtype=int)
+    durs, dists, vels, fcs, pwrs = (
+        laps[c].fillna(0).to_numpy(dtype=float)
+        for c in ['Durata Lap (sec)', 'Distanza Lap (m)', 'Velocità Media Lap (m/s)',
+                  'FC Media Lap (bpm)', 'Potenza Media Lap (W)']
+    )
+    
+    # Durata lap
+    dur_min = (durs // 60).astype(int)
+    dur_sec = (durs % 60).astype(int)
+    
+    # Passo/velocità lap (stessa unità per tutti i lap dell'attività)
+    has_pace = (vels > 0) & (dists > 0)
+    if 'run' in sport or 'walk' in sport:
+        unit, suffix = 1000, '/km'
+    elif 'swim' in sport:
+        unit, suffix = 100, '/100m'
+    else:
+        unit = None
+
+    if unit:
+        with np.errstate(divide='ignore'):
+            pace = np.where(has_pace, unit / vels, 0)
+        pace_m = (pace // 60).astype(int)
+        pace_s = (pace % 60).astype(int)
+        pace_fmts = [f"{m}:{s:02d}{suffix}" if ok else "" for ok, m, s in zip(has_pace, pace_m, pace_s)]
+    else:
+        pace_fmts = [f"{v * 3.6:.1f}km/h" if ok else "" for ok, v in zip(has_pace, vels)]
+    
+    show_pwr = 'cycl' in sport
+    return [
+        ", ".join(x for x in (
+            f"Lap{n}: {m}:{s:02d}",
+            f"{dist:.0f}m" if dist > 0 else "",
+            pace_fmt,
+            f"FC{int(fc)}" if fc > 0 else "",
+            f"{int(pwr)}W" if show_pwr and pwr > 0 else "",
+        ) if x)
+        for n, m, s, dist, pace_fmt, fc, pwr in zip(nums, dur_min, dur_sec, dists, pace_fmts, fcs, pwrs)
+    ]
+
+@st.cache_data(show_spinner=False)
+def load_lap_groups(file_bytes):
+    """Indicizza i lap per ActivityID (già ordinati per numero lap)"""
+    _, df_raw = load_excel_data(file_bytes)
+    return {aid: g.sort_values('Numero Lap') for aid, g in df_raw.groupby('ActivityID', sort=False)}
+
+@st.cache_data(show_spinner=False)
+def build_training_data(file_bytes, ftp, lthr, today):
+    """Calcola TSS e PMC; ricalcolato solo se cambiano file, FTP, LTHR o giorno"""
+    df, df_raw = load_excel_data(file_bytes)
+    
+    # Sport in minuscolo e flag per disciplina, calcolati una volta sola
+    sport_lc = df['Attivita_Tipo Sport'].fillna('').astype(str).str.lower()
+    df['_sport_lc'] = sport_lc
+    df['_is_cycl'] = sport_lc.str.contains('cycl', regex=False)
+    df['_is_run'] = sport_lc.str.contains('run', regex=False)
+    df['_is_swim'] = sport_lc.str.contains('swim', regex=False)
+    df['_is_walk'] = sport_lc.str.contains('walk', regex=False)
+    if 'Attivita_Sub Sport' in df.columns:
+        sub_sport_lc = df['Attivita_Sub Sport'].fillna('').astype(str).str.lower()
+        df['_indoor'] = sub_sport_lc.str.contains('indoor|virtual|treadmill')
+    else:
+        df['_indoor'] = False
+    
+    # Calcola TSS
+    df['TSS'] = calculate_sport_tss(df, ftp, lthr)
+    
+    # Prepara date
+    df['Date'] = pd.to_datetime(df['Attivita_Data Inizio'])
+    df = df.dropna(subset=['Date'])
+    df = df.sort_values('Date')
+    
+    # Normalizza date a mezzanotte per aggregazione giornaliera
+    df['Date'] = df['Date'].dt.normalize()
+    
+    # Aggrega TSS giornaliero
+    daily_tss = df.groupby('Date')['TSS'].sum()
+    
+    # Crea range continuo: reindex sul DatetimeIndex, i giorni senza attività valgono 0
+    date_range = pd.date_range(start=df['Date'].min(), end=today, freq='D')
+    tss = daily_tss.reindex(date_range, fill_value=0.0)
+    pmc_df = pd.DataFrame({'Date': date_range, 'TSS': tss.to_numpy()})
+    
+    # Calcola PMC
+    pmc_df['CTL'], pmc_df['ATL'], pmc_df['TSB'] = calculate_pmc(pmc_df['TSS'])
+    return df, df_raw, pmc_df
+
+@st.cache_data(show_spinner=False)
+def build_prompt(file_bytes, ftp, lthr, age, today):
+    """Genera il prompt per l'AI Coach; in cache finché non cambiano dati, parametri o giorno"""
+    df, _, pmc_df = build_training_data(file_bytes, ftp, lthr, today)
+    lap_groups = load_lap_groups(file_bytes)
+    
+    latest = pmc_df.iloc[-1]
+    week_ago = pmc_df.iloc[-8] if len(pmc_df) > 7 else latest
+    
+    # Ultimi 7 giorni (le date sono a mezzanotte: esclude il giorno di 7 giorni fa).
+    # df è ordinato per data: basta una ricerca binaria e uno slice, niente maschera
+    start_idx = np.searchsorted(df['Date'].to_numpy(), np.datetime64(today - timedelta(days=7)), side='right')
+    last_week = df.iloc[start_idx:]
+    weekly_tss = last_week['TSS'].sum()
+    
+    # Genera descrizione dettagliata degli allenamenti
+    workouts = []
+    for _, row in last_week.iterrows():
+        activity_id = row['ActivityID']
+        sport = row['_sport_lc']
+        is_cycl, is_run, is_swim, is_walk = row['_is_cycl'], row['_is_run'], row['_is_swim'], row['_is_walk']
+        
+        # Nome TSS sport-specific
+        if is_swim:
+            tss_name = 'sTSS'
+        elif is_run:
+            tss_name = 'rTSS'
+        else:
+            tss_name = 'TSS'
+        
+        # Indoor/Outdoor
+        indoor = 'Indoor' if row['_indoor'] else 'Outdoor'
+        
+        # Durata totale
+        dur_sec = row.get('Attivita_Durata Totale (sec)', 0) or 0
+        dur_min = int(dur_sec / 60)
+        
+        # Distanza totale
+        dist_km = row.get('Attivita_Distanza (km)', 0) or 0
+        
+        # Velocità/Passo media
+        vel_ms = row.get('Attivita_Velocità Media (m/s)', 0) or 0
+        if vel_ms > 0 and dist_km > 0:
+            if is_run or is_walk:
+                pace_sec_per_km = 1000 / vel_ms
+                pace_min = int(pace_sec_per_km / 60)
+                pace_sec = int(pace_sec_per_km % 60)
+                speed_str = f"Passo medio {pace_min}:{pace_sec:02d}/km"
+            elif is_swim:
+                pace_sec_per_100m = 100 / vel_ms
+                pace_min = int(pace_sec_per_100m / 60)
+                pace_sec = int(pace_sec_per_100m % 60)
+                speed_str = f"Passo medio {pace_min}:{pace_sec:02d}/100m"
+            else:
+                speed_kmh = vel_ms * 3.6
+                speed_str = f"Vel. media {speed_kmh:.1f} km/h"
+        else:
+            speed_str = ""
+        
+        # FC Media
+        fc = row.get('Attivita_FC Media (bpm)', 0) or 0
+        fc_str = f"FC media {int(fc)} bpm" if fc > 0 else ""
+        
+        # Potenza (solo ciclismo)
+        pwr = row.get('Attivita_Potenza Normalizzata (W)', 0) or 0
+        pwr_str = f"NP {int(pwr)}W" if pwr > 0 and is_cycl else ""
+        
+        # Riga principale workout
+        workout_line = f"- {row['Date'].strftime('%Y-%m-%d')}: {row['Attivita_Tipo Sport'].capitalize()} ({indoor}) - {dur_min}min, {dist_km:.1f}km - {row['TSS']:.0f} {tss_name}"
+        details = [x for x in [speed_str, fc_str, pwr_str] if x]
+        if details:
+            workout_line += f"\n  Medie: {', '.join(details)}"
+        
+        # DETTAGLIO LAP
+        laps = lap_groups.get(activity_id)
+        if laps is not None and len(laps) > 1:  # Solo se ci sono più lap
+            lap_details = format_lap_details(laps, sport)
+            
+            # Mostra tutti i lap
+            workout_line += f"\n  Lap ({len(lap_details)}): " + " | ".join(lap_details)
+        
+        workouts.append(workout_line)
+
+    prompt = f"""Sono un atleta di {age} anni.
+
+LEGENDA TSS:
+- TSS = Training Stress Score (ciclismo con potenza)
+- rTSS = Running Training Stress Score (corsa basato su FC)
+- sTSS = Swimming Training Stress Score (nuoto basato su FC)
+
+MIO PIANO SETTIMANALE TIPICO:
+- Lunedì: Mattina nuoto tecnica
+- Martedì: Mattina bici VO2max, Pausa pranzo palestra parte superiore
+- Mercoledì: Mattina ripetute corsa soglia, Pausa pranzo nuoto velocità
+- Giovedì: Mattina forza bici, Pausa pranzo palestra parte inferiore
+- Venerdì: Mattina corsa zona 2, Pausa pranzo nuoto pull + palette
+- Sabato: Mattina lungo bici
+- Domenica: Mattina lungo corsa
+
+METRICHE PMC ATTUALI:
+- CTL (Chronic Training Load / Fitness): {latest['CTL']:.1f}
+- ATL (Acute Training Load / Fatigue): {latest['ATL']:.1f}
+- TSB (Training Stress Balance / Form): {latest['TSB']:.1f}
+- Ramp Rate (Δ CTL/settimana): {(latest['CTL'] - week_ago['CTL']):+.1f}
+
+CARICO ULTIMA SETTIMANA:
+- TSS Totale: {weekly_tss:.0f}
+- Numero allenamenti: {len(last_week)}
+
+DETTAGLIO ALLENAMENTI ULTIMI 7 GIORNI:
+{chr(10).join(workouts) if workouts else "Nessun allenamento"}
+
+INTERPRETAZIONE METRICHE:
+- TSB > +5: Buona forma, pronto per gare/sforzi intensi
+- TSB -10 a +5: Stato di allenamento normale
+- TSB < -10: Affaticamento accumulato, considera recupero
+- Ramp Rate ideale: 3-8 CTL/settimana
+- Ramp Rate > 10: Rischio sovrallenamento
+
+RICHIESTA:
+Analizza la mia condizione attuale basandoti sui dati PMC e sugli allenamenti specifici (tipologia, intensità, volume). 
+Confronta gli allenamenti fatti con il mio piano tipico e suggerisci:
+1. Se devo modificare il piano questa settimana in base alla mia forma (TSB)
+2. Intensità e volume consigliati per ogni sessione
+3. Range di TSS/rTSS/sTSS target per ogni sessione
+4. Se c'è bisogno di più recupero o posso caricare di più"""
+    
+    return prompt
+
 # ============================================================================
 # SIDEBAR
 # ============================================================================
@@ -86,50 +334,26 @@ st.markdown("### Performance Management Dashboard")
 
 # Trova file
 script_dir = Path(__file__).parent.resolve()
-file_path = None
+file_bytes = None
 
 if uploaded_file:
-    file_path = uploaded_file
+    file_bytes = uploaded_file.getvalue()
 else:
     # Cerca nella directory dello script
     local_file = script_dir / 'Storico_Allenamenti_Garmin.xlsx'
     if local_file.exists():
-        file_path = str(local_file)
+        file_bytes = local_file.read_bytes()
     else:
         st.error(f"❌ File non trovato in: {script_dir}")
 
-if not file_path:
+if not file_bytes:
     st.warning("⚠️ Carica un file Excel dalla sidebar")
     st.stop()
 
 # Carica dati
 with st.spinner("Caricamento..."):
-    df, df_raw = load_excel_data(file_path)
-    
-    # Calcola TSS
-    df['TSS'] = df.apply(lambda row: calculate_sport_tss(row, ftp, lthr), axis=1)
-    
-    # Prepara date
-    df['Date'] = pd.to_datetime(df['Attivita_Data Inizio'])
-    df = df.dropna(subset=['Date'])
-    df = df.sort_values('Date')
-    
-    # Normalizza date a mezzanotte per aggregazione giornaliera
-    df['Date'] = df['Date'].dt.normalize()
-    
-    # Aggrega TSS giornaliero
-    daily_tss = df.groupby('Date')['TSS'].sum().reset_index()
-    
-    # Crea range continuo
-    date_range = pd.date_range(start=df['Date'].min(), end=datetime.now(), freq='D')
-    pmc_df = pd.DataFrame({'Date': date_range})
-    
-    # Merge con merge (non con index)
-    pmc_df = pmc_df.merge(daily_tss, on='Date', how='left')
-    pmc_df['TSS'] = pmc_df['TSS'].fillna(0)
-    
-    # Calcola PMC
-    pmc_df['CTL'], pmc_df['ATL'], pmc_df['TSB'] = calculate_pmc(pmc_df['TSS'])
+    today = pd.Timestamp.now().normalize()
+    df, df_raw, pmc_df = build_training_data(file_bytes, ftp, lthr, today)
 
 # KPI
 st.subheader("📊 Metriche Correnti")
@@ -201,163 +425,7 @@ st.plotly_chart(fig, use_container_width=True)
 st.divider()
 st.subheader("🤖 AI Coach Analysis Export")
 
-last_week = df[df['Date'] >= datetime.now() - timedelta(days=7)]
-weekly_tss = last_week['TSS'].sum()
-
-# Genera descrizione dettagliata degli allenamenti
-workouts = []
-for _, row in last_week.iterrows():
-    activity_id = row['ActivityID']
-    sport = str(row['Attivita_Tipo Sport']).lower() if pd.notna(row['Attivita_Tipo Sport']) else 'unknown'
-    sub_sport = str(row.get('Attivita_Sub Sport', '')).lower() if pd.notna(row.get('Attivita_Sub Sport', '')) else ''
-    
-    # Nome TSS sport-specific
-    if 'swim' in sport:
-        tss_name = 'sTSS'
-    elif 'run' in sport:
-        tss_name = 'rTSS'
-    else:
-        tss_name = 'TSS'
-    
-    # Indoor/Outdoor
-    indoor = 'Indoor' if 'indoor' in sub_sport or 'virtual' in sub_sport or 'treadmill' in sub_sport else 'Outdoor'
-    
-    # Durata totale
-    dur_sec = row.get('Attivita_Durata Totale (sec)', 0) or 0
-    dur_min = int(dur_sec / 60)
-    
-    # Distanza totale
-    dist_km = row.get('Attivita_Distanza (km)', 0) or 0
-    
-    # Velocità/Passo media
-    vel_ms = row.get('Attivita_Velocità Media (m/s)', 0) or 0
-    if vel_ms > 0 and dist_km > 0:
-        if 'run' in sport or 'walk' in sport:
-            pace_sec_per_km = 1000 / vel_ms
-            pace_min = int(pace_sec_per_km / 60)
-            pace_sec = int(pace_sec_per_km % 60)
-            speed_str = f"Passo medio {pace_min}:{pace_sec:02d}/km"
-        elif 'swim' in sport:
-            pace_sec_per_100m = 100 / vel_ms
-            pace_min = int(pace_sec_per_100m / 60)
-            pace_sec = int(pace_sec_per_100m % 60)
-            speed_str = f"Passo medio {pace_min}:{pace_sec:02d}/100m"
-        else:
-            speed_kmh = vel_ms * 3.6
-            speed_str = f"Vel. media {speed_kmh:.1f} km/h"
-    else:
-        speed_str = ""
-    
-    # FC Media
-    fc = row.get('Attivita_FC Media (bpm)', 0) or 0
-    fc_str = f"FC media {int(fc)} bpm" if fc > 0 else ""
-    
-    # Potenza (solo ciclismo)
-    pwr = row.get('Attivita_Potenza Normalizzata (W)', 0) or 0
-    pwr_str = f"NP {int(pwr)}W" if pwr > 0 and 'cycl' in sport else ""
-    
-    # Riga principale workout
-    workout_line = f"- {row['Date'].strftime('%Y-%m-%d')}: {row['Attivita_Tipo Sport'].capitalize()} ({indoor}) - {dur_min}min, {dist_km:.1f}km - {row['TSS']:.0f} {tss_name}"
-    details = [x for x in [speed_str, fc_str, pwr_str] if x]
-    if details:
-        workout_line += f"\n  Medie: {', '.join(details)}"
-    
-    # DETTAGLIO LAP
-    laps = df_raw[df_raw['ActivityID'] == activity_id].sort_values('Numero Lap')
-    if len(laps) > 1:  # Solo se ci sono più lap
-        lap_details = []
-        for lap_idx, lap in laps.iterrows():
-            lap_num = int(lap.get('Numero Lap', 0))
-            lap_dur = lap.get('Durata Lap (sec)', 0) or 0
-            lap_dist_m = lap.get('Distanza Lap (m)', 0) or 0
-            lap_vel = lap.get('Velocità Media Lap (m/s)', 0) or 0
-            lap_fc = lap.get('FC Media Lap (bpm)', 0) or 0
-            lap_pwr = lap.get('Potenza Media Lap (W)', 0) or 0
-            
-            # Formatta durata lap
-            lap_dur_min = int(lap_dur / 60)
-            lap_dur_sec = int(lap_dur % 60)
-            dur_fmt = f"{lap_dur_min}:{lap_dur_sec:02d}"
-            
-            # Formatta passo/velocità lap
-            if lap_vel > 0 and lap_dist_m > 0:
-                if 'run' in sport or 'walk' in sport:
-                    pace_sec_km = 1000 / lap_vel
-                    pace_m = int(pace_sec_km / 60)
-                    pace_s = int(pace_sec_km % 60)
-                    pace_fmt = f"{pace_m}:{pace_s:02d}/km"
-                elif 'swim' in sport:
-                    pace_sec_100 = 100 / lap_vel
-                    pace_m = int(pace_sec_100 / 60)
-                    pace_s = int(pace_sec_100 % 60)
-                    pace_fmt = f"{pace_m}:{pace_s:02d}/100m"
-                else:
-                    pace_fmt = f"{lap_vel * 3.6:.1f}km/h"
-            else:
-                pace_fmt = ""
-            
-            # Componi stringa lap
-            lap_info = f"Lap{lap_num}: {dur_fmt}"
-            if lap_dist_m > 0:
-                lap_info += f", {lap_dist_m:.0f}m"
-            if pace_fmt:
-                lap_info += f", {pace_fmt}"
-            if lap_fc > 0:
-                lap_info += f", FC{int(lap_fc)}"
-            if lap_pwr > 0 and 'cycl' in sport:
-                lap_info += f", {int(lap_pwr)}W"
-            
-            lap_details.append(lap_info)
-        
-        # Mostra tutti i lap
-        workout_line += f"\n  Lap ({len(lap_details)}): " + " | ".join(lap_details)
-    
-    workouts.append(workout_line)
-
-prompt = f"""Sono un atleta di {age} anni.
-
-LEGENDA TSS:
-- TSS = Training Stress Score (ciclismo con potenza)
-- rTSS = Running Training Stress Score (corsa basato su FC)
-- sTSS = Swimming Training Stress Score (nuoto basato su FC)
-
-MIO PIANO SETTIMANALE TIPICO:
-- Lunedì: Mattina nuoto tecnica
-- Martedì: Mattina bici VO2max, Pausa pranzo palestra parte superiore
-- Mercoledì: Mattina ripetute corsa soglia, Pausa pranzo nuoto velocità
-- Giovedì: Mattina forza bici, Pausa pranzo palestra parte inferiore
-- Venerdì: Mattina corsa zona 2, Pausa pranzo nuoto pull + palette
-- Sabato: Mattina lungo bici
-- Domenica: Mattina lungo corsa
-
-METRICHE PMC ATTUALI:
-- CTL (Chronic Training Load / Fitness): {latest['CTL']:.1f}
-- ATL (Acute Training Load / Fatigue): {latest['ATL']:.1f}
-- TSB (Training Stress Balance / Form): {latest['TSB']:.1f}
-- Ramp Rate (Δ CTL/settimana): {(latest['CTL'] - week_ago['CTL']):+.1f}
-
-CARICO ULTIMA SETTIMANA:
-- TSS Totale: {weekly_tss:.0f}
-- Numero allenamenti: {len(last_week)}
-
-DETTAGLIO ALLENAMENTI ULTIMI 7 GIORNI:
-{chr(10).join(workouts) if workouts else "Nessun allenamento"}
-
-INTERPRETAZIONE METRICHE:
-- TSB > +5: Buona forma, pronto per gare/sforzi intensi
-- TSB -10 a +5: Stato di allenamento normale
-- TSB < -10: Affaticamento accumulato, considera recupero
-- Ramp Rate ideale: 3-8 CTL/settimana
-- Ramp Rate > 10: Rischio sovrallenamento
-
-RICHIESTA:
-Analizza la mia condizione attuale basandoti sui dati PMC e sugli allenamenti specifici (tipologia, intensità, volume). 
-Confronta gli allenamenti fatti con il mio piano tipico e suggerisci:
-1. Se devo modificare il piano questa settimana in base alla mia forma (TSB)
-2. Intensità e volume consigliati per ogni sessione
-3. Range di TSS/rTSS/sTSS target per ogni sessione
-4. Se c'è bisogno di più recupero o posso caricare di più"""
-
+prompt = build_prompt(file_bytes, ftp, lthr, age, today)
 st.code(prompt, language=None)
 
 # Riepilogo
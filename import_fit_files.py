@@ -7,13 +7,40 @@ Parses FIT files and creates a JSON database for the web app to load
 import os
 import sys
 import json
+import array
 import struct
-from datetime import datetime, timedelta
+from multiprocessing import Pool
+from datetime import date, datetime, timedelta
 from pathlib import Path
 
+import numpy as np
+
+# Numba is optional: without it the PMC kernel runs as plain Python and the
+# TSS formulas as ordinary NumPy array expressions
+try:
+    from numba import njit, vectorize
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    
+    def vectorize(*args, **kwargs):
+        return lambda func: func
+
 # FIT file constants
 FIT_EPOCH = datetime(1989, 12, 31, 0, 0, 0)
 
+# Pre-compiled decoders per (size, little_endian): format string parsed once
+FIELD_DECODERS = {
+    (1, True): struct.Struct('B').unpack_from,
+    (1, False): struct.Struct('B').unpack_from,
+    (2, True): struct.Struct('<H').unpack_from,
+    (2, False): struct.Struct('>H').unpack_from,
+    (4, True): struct.Struct('<I').unpack_from,
+    (4, False): struct.Struct('>I').unpack_from,
+}
+
 class FITParser:
     def __init__(self):
         self.sport_types = {
@@ -57,14 +84,15 @@ class FITParser:
         if signature != b'.FIT':
             return None
         
-        data_size = struct.unpack('<I', data[4:8])[0]
+        data_size = FIELD_DECODERS[(4, True)](data, 4)[0]
         offset = header_size
-        end_offset = header_size + data_size
+        end_offset = min(header_size + data_size, len(data))
         
-        power_values = []
-        hr_values = []
+        # Typed buffers: no boxed ints per sample, and NumPy can view them without copying
+        power_values = array.array('H')
+        hr_values = array.array('B')
         
-        while offset < end_offset and offset < len(data):
+        while offset < end_offset:
             try:
                 record_header = data[offset]
                 offset += 1
@@ -86,15 +114,14 @@ class FITParser:
         
         # Calculate derived metrics
         if power_values:
-            activity['avgPower'] = int(sum(power_values) / len(power_values))
+            power = np.frombuffer(power_values, dtype=np.uint16)
+            activity['avgPower'] = int(power.sum() / len(power))
             # Simple NP approximation
-            if len(power_values) > 30:
-                rolling = []
-                for i in range(29, len(power_values)):
-                    avg = sum(power_values[i-29:i+1]) / 30
-                    rolling.append(avg ** 4)
-                if rolling:
-                    activity['normalizedPower'] = int((sum(rolling) / len(rolling)) ** 0.25)
+            if len(power) > 30:
+                # 30s moving average via cumulative sum (exact for integer watts)
+                csum = np.concatenate(([0.0], np.cumsum(power, dtype=np.float64)))
+                rolling = (csum[30:] - csum[:-30]) / 30
+                activity['normalizedPower'] = int(np.mean(rolling ** 4) ** 0.25)
         
         if hr_values:
             activity['avgHR'] = int(sum(hr_values) / len(hr_values))
@@ -111,29 +138,24 @@ class FITParser:
         offset += 1
         little_endian = architecture == 0
         
-        if little_endian:
-            global_msg = struct.unpack('<H', data[offset:offset+2])[0]
-        else:
-            global_msg = struct.unpack('>H', data[offset:offset+2])[0]
+        global_msg = FIELD_DECODERS[(2, little_endian)](data, offset)[0]
         offset += 2
         
         num_fields = data[offset]
         offset += 1
         
-        fields = []
+        # Resolve each field's decoder once per definition (None = skipped size)
+        decoders = []
         for _ in range(num_fields):
             if offset + 3 > len(data):
                 break
-            fields.append({
-                'num': data[offset],
-                'size': data[offset + 1],
-                'type': data[offset + 2]
-            })
+            size = data[offset + 1]
+            decoders.append((data[offset], size, FIELD_DECODERS.get((size, little_endian))))
             offset += 3
         
         self.local_messages[local_msg_type] = {
             'global': global_msg,
-            'fields': fields,
+            'decoders': decoders,
             'little_endian': little_endian
         }
         
@@ -146,22 +168,14 @@ class FITParser:
         msg_def = self.local_messages[local_msg_type]
         values = {}
         
-        for field in msg_def['fields']:
-            if offset + field['size'] > len(data):
+        data_len = len(data)
+        for num, size, decode in msg_def['decoders']:
+            if offset + size > data_len:
                 return None
             
-            try:
-                if field['size'] == 1:
-                    values[field['num']] = data[offset]
-                elif field['size'] == 2:
-                    fmt = '<H' if msg_def['little_endian'] else '>H'
-                    values[field['num']] = struct.unpack(fmt, data[offset:offset+2])[0]
-                elif field['size'] == 4:
-                    fmt = '<I' if msg_def['little_endian'] else '>I'
-                    values[field['num']] = struct.unpack(fmt, data[offset:offset+4])[0]
-            except:
-                pass
-            offset += field['size']
+            if decode is not None:
+                values[num] = decode(data, offset)[0]
+            offset += size
         
         return {
             'offset': offset,
@@ -203,93 +217,82 @@ class FITParser:
             if 7 in values and 0 < values[7] < 65535:
                 power_values.append(values[7])
 
+@vectorize(['float64(float64, float64, float64)'], cache=True)
+def _power_tss(duration, power, ftp):
+    intensity = power / ftp
+    return (duration * power * intensity) / (ftp * 3600) * 100
+
+@vectorize(['float64(float64, float64)'], cache=True)
+def _run_tss(duration, intensity):
+    return (duration / 3600) * (intensity ** 2) * 100
+
+# Use IF^2 like running (IF^3 underestimates for slower paces)
+@vectorize(['float64(float64, float64)'], cache=True)
+def _swim_tss(duration, intensity):
+    return (intensity ** 2) * (duration / 3600) * 100
+
 class TSSCalculator:
     def __init__(self, ftp=300, run_threshold=256, swim_threshold=100):
         self.ftp = ftp
         self.run_threshold = run_threshold  # seconds per km
         self.swim_threshold = swim_threshold  # seconds per 100m
     
-    def calculate(self, activity):
-        sport = activity.get('sport', 'unknown')
-        
-        if sport == 'cycling':
-            return self._cycling_tss(activity)
-        elif sport == 'running':
-            return self._running_tss(activity)
-        elif sport == 'swimming':
-            return self._swimming_tss(activity)
-        else:
-            return self._hr_tss(activity)
-    
-    def _cycling_tss(self, activity):
-        duration = activity.get('duration', 0)
-        np = activity.get('normalizedPower') or activity.get('avgPower')
-        
-        if not np or not duration:
-            return self._hr_tss(activity)
-        
-        IF = np / self.ftp
-        tss = (duration * np * IF) / (self.ftp * 3600) * 100
-        
-        return {
-            'tss': round(tss),
-            'type': 'TSS',
-            'IF': round(IF, 2)
-        }
-    
-    def _running_tss(self, activity):
-        duration = activity.get('duration', 0)
-        distance = activity.get('distance', 0)
-        
-        if not duration or not distance or distance < 100:
-            return self._hr_tss(activity)
-        
-        pace_per_km = duration / (distance / 1000)
-        IF = self.run_threshold / pace_per_km
-        hours = duration / 3600
-        rtss = hours * (IF ** 2) * 100
-        
-        return {
-            'tss': round(rtss),
-            'type': 'rTSS',
-            'IF': round(IF, 2)
-        }
-    
-    def _swimming_tss(self, activity):
-        duration = activity.get('duration', 0)
-        distance = activity.get('distance', 0)
-        
-        if not duration or not distance or distance < 25:
-            return self._hr_tss(activity)
-        
-        pace_per_100m = duration / (distance / 100)
-        IF = self.swim_threshold / pace_per_100m
-        hours = duration / 3600
-        # Use IF^2 like running (IF^3 underestimates for slower paces)
-        stss = (IF ** 2) * hours * 100
-        
-        return {
-            'tss': round(stss),
-            'type': 'sTSS',
-            'IF': round(IF, 2)
-        }
+    def calculate_batch(self, activities):
+        """TSS for all activities at once: power TSS for cycling, rTSS for runs
+        of at least 100 m, sTSS for swims of at least 25 m, otherwise a
+        duration-based hrTSS (25/h gym, 40/h cardio).
+        Returns parallel lists of tss, type and IF."""
+        if not activities:
+            return [], [], []
+        
+        sport = np.array([a.get('sport', 'unknown') for a in activities])
+        duration = np.array([a.get('duration') or 0 for a in activities], dtype=np.float64)
+        distance = np.array([a.get('distance') or 0 for a in activities], dtype=np.float64)
+        power = np.array([a.get('normalizedPower') or a.get('avgPower') or 0 for a in activities],
+                         dtype=np.float64)
+        
+        is_cycling = (sport == 'cycling') & (power > 0) & (duration > 0)
+        is_running = (sport == 'running') & (duration > 0) & (distance >= 100)
+        is_swimming = (sport == 'swimming') & (duration > 0) & (distance >= 25)
+        is_gym = (sport == 'fitness_equipment') | (sport == 'generic')
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cycling_if = power / self.ftp
+            running_if = self.run_threshold / (duration / (distance / 1000))
+            swimming_if = self.swim_threshold / (duration / (distance / 100))
+            
+            conditions = [is_cycling, is_running, is_swimming]
+            tss = np.select(conditions, [
+                _power_tss(duration, power, float(self.ftp)),
+                _run_tss(duration, running_if),
+                _swim_tss(duration, swimming_if),
+            ], default=(duration / 3600) * np.where(is_gym, 25, 40))
+            intensity = np.select(conditions, [cycling_if, running_if, swimming_if],
+                                  default=np.where(sport == 'fitness_equipment', 0.5, 0.7))
+            tss_type = np.select(conditions, ['TSS', 'rTSS', 'sTSS'], default='hrTSS')
+        
+        return ([round(t) for t in tss.tolist()],
+                tss_type.tolist(),
+                [round(f, 2) for f in intensity.tolist()])
+
+def _process_one(job):
+    """Parse a single FIT file (top-level so Pool can pickle it)"""
+    i, fit_path = job
     
-    def _hr_tss(self, activity):
-        duration = activity.get('duration', 0)
-        sport = activity.get('sport', 'unknown')
-        hours = duration / 3600
-        
-        # Gym/weights activities have lower TSS than cardio
-        if sport == 'fitness_equipment' or sport == 'generic':
-            tss_per_hour = 25  # Pesi/palestra
-        else:
-            tss_per_hour = 40  # Other cardio activities
-        
-        return {
-            'tss': round(hours * tss_per_hour),
-            'type': 'hrTSS',
-            'IF': 0.5 if sport == 'fitness_equipment' else 0.7
-        }
+    activity = FITParser().parse(fit_path)
+    if not activity or not activity.get('startTime'):
+        return i, None
+    return i, activity
+
+@njit(cache=True)
+def pmc(daily, ctl_decay, atl_decay):
+    """Run the CTL/ATL exponential decay over a dense daily TSS array"""
+    ctl = 0.0
+    atl = 0.0
+    for i in range(len(daily)):
+        ctl = ctl * ctl_decay + daily[i] * (1 - ctl_decay)
+        atl = atl * atl_decay + daily[i] * (1 - atl_decay)
+    return ctl, atl
 
 def main():
     fit_dir = Path('/Users/marco/.gemini/antigravity/scratch/garmin_analyzer/fit_files')
@@ -297,7 +300,6 @@ def main():
     
     output_file.parent.mkdir(parents=True, exist_ok=True)
     
-    parser = FITParser()
     tss_calc = TSSCalculator(ftp=300, run_threshold=256, swim_threshold=100)
     
     fit_files = sorted(fit_dir.glob('*.fit'))
@@ -306,27 +308,34 @@ def main():
     print(f"Trovati {total} file FIT")
     print("Parsing in corso...")
     
-    activities = []
+    parsed = []
     errors = 0
     
-    for i, fit_file in enumerate(fit_files, 1):
-        if i % 50 == 0:
-            print(f"  Processati {i}/{total}...")
-        
-        activity = parser.parse(str(fit_file))
-        if activity and activity.get('startTime'):
-            # Calculate TSS
-            tss_result = tss_calc.calculate(activity)
-            activity['tss'] = tss_result['tss']
-            activity['tssType'] = tss_result['type']
-            activity['IF'] = tss_result['IF']
-            
-            # Generate ID
-            activity['id'] = f"{activity['sport']}_{activity['startTime']}_{i}"
+    # Files are independent: parse them across all cores
+    jobs = [(i, str(fit_file)) for i, fit_file in enumerate(fit_files, 1)]
+    chunksize = max(1, total // ((os.cpu_count() or 1) * 4))
+    
+    with Pool() as pool:
+        for done, (i, activity) in enumerate(pool.imap_unordered(_process_one, jobs, chunksize=chunksize), 1):
+            if done % 50 == 0:
+                print(f"  Processati {done}/{total}...")
             
-            activities.append(activity)
-        else:
-            errors += 1
+            if activity:
+                parsed.append((i, activity))
+            else:
+                errors += 1
+    
+    # Calculate TSS for all activities in one vectorized pass
+    activities = [activity for _, activity in parsed]
+    tss_values, tss_types, if_values = tss_calc.calculate_batch(activities)
+    
+    for (i, activity), tss, tss_type, intensity in zip(parsed, tss_values, tss_types, if_values):
+        activity['tss'] = tss
+        activity['tssType'] = tss_type
+        activity['IF'] = intensity
+        
+        # Generate ID
+        activity['id'] = f"{activity['sport']}_{activity['startTime']}_{i}"
     
     # Sort by date (newest first)
     activities.sort(key=lambda x: x.get('startTime', ''), reverse=True)
@@ -339,39 +348,44 @@ def main():
             'activities': activities
         }, f, indent=2)
     
+    # Columnar copy for Python-side analysis (the web app keeps reading the JSON)
+    parquet_file = output_file.with_suffix('.parquet')
+    try:
+        import pandas as pd
+        pd.DataFrame(activities).drop(columns=['laps'], errors='ignore').to_parquet(
+            parquet_file, compression='snappy', index=False)
+    except ImportError:
+        parquet_file = None
+    
     print(f"\n✅ Completato!")
     print(f"   Attività importate: {len(activities)}")
     print(f"   Errori: {errors}")
     print(f"   File salvato: {output_file}")
+    if parquet_file:
+        print(f"   Parquet: {parquet_file}")
     
     # Calculate PMC
     daily_tss = {}
     for a in activities:
-        date = a['startTime'][:10]
-        daily_tss[date] = daily_tss.get(date, 0) + a['tss']
+        day = a['startTime'][:10]
+        daily_tss[day] = daily_tss.get(day, 0) + a['tss']
     
     # Calculate current CTL/ATL
     ctl_decay = 0.9762  # e^(-1/42)
     atl_decay = 0.8681  # e^(-1/7)
-    ctl = 0
-    atl = 0
     
     dates = sorted(daily_tss.keys())
     if dates:
-        # Fill in missing days
-        start = datetime.strptime(dates[0], '%Y-%m-%d')
-        end = datetime.now()
-        current = start
-        
-        while current <= end:
-            date_str = current.strftime('%Y-%m-%d')
-            tss = daily_tss.get(date_str, 0)
-            
-            ctl = ctl * ctl_decay + tss * (1 - ctl_decay)
-            atl = atl * atl_decay + tss * (1 - atl_decay)
-            
-            current += timedelta(days=1)
-        
+        # Dense day-indexed array (missing days stay at 0)
+        start = date.fromisoformat(dates[0])
+        n_days = (date.today() - start).days + 1
+        daily = np.zeros(max(n_days, 0), dtype=np.float64)
+        for day, tss in daily_tss.items():
+            idx = (date.fromisoformat(day) - start).days
+            if idx < n_days:
+                daily[idx] = tss
+        
+        ctl, atl = pmc(daily, ctl_decay, atl_decay)
         tsb = ctl - atl
         
         print(f"\n📊 PMC Attuale:")
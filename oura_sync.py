@@ -7,8 +7,13 @@ Syncs sleep, readiness, activity and HRV data from Oura Ring
 import os
 import sys
 import json
+import time
 import webbrowser
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlencode, parse_qs, urlparse
 import ssl
@@ -21,6 +26,15 @@ except ImportError:
     os.system(f"{sys.executable} -m pip install requests")
     import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Faster JSON encode/decode when orjson is available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configuration
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'data', 'oura_config.json')
 DATA_FILE = os.path.join(os.path.dirname(__file__), 'data', 'oura.json')
@@ -29,16 +43,34 @@ OURA_AUTH_URL = 'https://cloud.ouraring.com/oauth/authorize'
 OURA_TOKEN_URL = 'https://api.ouraring.com/oauth/token'
 OURA_API_BASE = 'https://api.ouraring.com/v2/usercollection'
 
+def json_loads(data):
+    """Parse JSON from bytes/str"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def write_json(path, obj):
+    """Write obj as indented JSON"""
+    if orjson:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+class OAuthCallbackServer(HTTPServer):
+    """One-shot OAuth2 callback server, the auth code is stored per instance"""
+    allow_reuse_address = True
+    timeout = 120  # handle_request() gives up if the browser never calls back
+    auth_code = None
+
 class OAuthCallbackHandler(BaseHTTPRequestHandler):
     """Handle OAuth2 callback"""
-    auth_code = None
     
     def do_GET(self):
         parsed = urlparse(self.path)
         if parsed.path == '/callback':
             params = parse_qs(parsed.query)
             if 'code' in params:
-                OAuthCallbackHandler.auth_code = params['code'][0]
+                self.server.auth_code = params['code'][0]
                 self.send_response(200)
                 self.send_header('Content-type', 'text/html')
                 self.end_headers()
@@ -62,19 +94,29 @@ class OAuthCallbackHandler(BaseHTTPRequestHandler):
 class OuraSync:
     def __init__(self):
         self.config = self.load_config()
+        # Cached refresh deadline (5 min before expiry), checked without datetime
+        self._token_valid_until = self.config.get('expires_at', 0) - 300
+        # One keep-alive session for token exchange and all API endpoints
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        if self.config.get('access_token'):
+            self._set_access_token(self.config['access_token'])
     
     def load_config(self):
         """Load OAuth configuration"""
         if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+            with open(CONFIG_FILE, 'rb') as f:
+                return json_loads(f.read())
         return {}
     
     def save_config(self):
         """Save OAuth configuration"""
         os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(self.config, f, indent=2)
+        write_json(CONFIG_FILE, self.config)
     
     def setup(self):
         """Interactive OAuth2 setup"""
@@ -115,18 +157,22 @@ class OuraSync:
         
         # Start callback server
         print("⏳ In attesa del callback OAuth...")
-        server = HTTPServer(('localhost', 8888), OAuthCallbackHandler)
-        server.handle_request()
-        
-        if not OAuthCallbackHandler.auth_code:
+        server = OAuthCallbackServer(('localhost', 8888), OAuthCallbackHandler)
+        try:
+            server.handle_request()
+        finally:
+            server.server_close()
+        auth_code = server.auth_code
+        
+        if not auth_code:
             print("❌ Autorizzazione fallita")
             return False
         
         # Exchange code for tokens
         print("🔄 Scambio codice per token...")
-        response = requests.post(OURA_TOKEN_URL, data={
+        response = self.session.post(OURA_TOKEN_URL, data={
             'grant_type': 'authorization_code',
-            'code': OAuthCallbackHandler.auth_code,
+            'code': auth_code,
             'redirect_uri': REDIRECT_URI,
             'client_id': client_id,
             'client_secret': client_secret
@@ -137,24 +183,34 @@ class OuraSync:
             return False
         
         tokens = response.json()
-        self.config['access_token'] = tokens['access_token']
+        self._set_access_token(tokens['access_token'])
         self.config['refresh_token'] = tokens['refresh_token']
-        self.config['expires_at'] = datetime.now().timestamp() + tokens.get('expires_in', 86400)
+        self._set_expiry(tokens.get('expires_in', 86400))
         
         self.save_config()
         print("\n✅ Configurazione completata!")
         return True
     
+    def _set_access_token(self, access_token):
+        """Store the access token and set the Authorization header once on the session"""
+        self.config['access_token'] = access_token
+        self.session.headers['Authorization'] = f"Bearer {access_token}"
+    
+    def _set_expiry(self, expires_in):
+        """Store token expiry and update the cached refresh deadline"""
+        self.config['expires_at'] = time.time() + expires_in
+        self._token_valid_until = self.config['expires_at'] - 300
+    
     def refresh_token(self):
         """Refresh access token if expired"""
         if not self.config.get('refresh_token'):
             return False
         
-        if datetime.now().timestamp() < self.config.get('expires_at', 0) - 300:
+        if time.time() < self._token_valid_until:
             return True  # Token still valid
         
         print("🔄 Rinnovo token...")
-        response = requests.post(OURA_TOKEN_URL, data={
+        response = self.session.post(OURA_TOKEN_URL, data={
             'grant_type': 'refresh_token',
             'refresh_token': self.config['refresh_token'],
             'client_id': self.config['client_id'],
@@ -166,28 +222,38 @@ class OuraSync:
             return False
         
         tokens = response.json()
-        self.config['access_token'] = tokens['access_token']
+        self._set_access_token(tokens['access_token'])
         self.config['refresh_token'] = tokens.get('refresh_token', self.config['refresh_token'])
-        self.config['expires_at'] = datetime.now().timestamp() + tokens.get('expires_in', 86400)
+        self._set_expiry(tokens.get('expires_in', 86400))
         self.save_config()
         return True
     
-    def get_headers(self):
-        """Get API headers with access token"""
-        return {'Authorization': f"Bearer {self.config['access_token']}"}
-    
     def fetch_data(self, endpoint, start_date, end_date):
         """Fetch data from Oura API"""
         url = f"{OURA_API_BASE}/{endpoint}"
         params = {'start_date': start_date, 'end_date': end_date}
-        response = requests.get(url, headers=self.get_headers(), params=params)
+        response = self.session.get(url, params=params)
         
         if response.status_code == 200:
-            return response.json().get('data', [])
+            return json_loads(response.content).get('data', [])
         else:
             print(f"⚠️ Errore fetching {endpoint}: {response.status_code}")
             return []
     
+    def load_existing(self, window_start):
+        """Load the previous oura.json if it covers the requested window"""
+        if not os.path.exists(DATA_FILE):
+            return None
+        try:
+            with open(DATA_FILE, 'rb') as f:
+                existing = json_loads(f.read())
+            datetime.fromisoformat(existing['syncDate'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if existing.get('startDate', window_start) > window_start:
+            return None  # Older days missing: do a full sync
+        return existing
+    
     def sync(self, days=42):
         """Sync Oura data for the last N days"""
         if not self.config.get('access_token'):
@@ -198,14 +264,23 @@ class OuraSync:
             print("❌ Token scaduto. Esegui: python3 oura_sync.py --setup")
             return False
         
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        now = datetime.now()
+        end_date = now.strftime('%Y-%m-%d')
+        window_start = (now - timedelta(days=days)).strftime('%Y-%m-%d')
+        start_date = window_start
+        
+        # Incremental sync: only fetch the days since the last sync (2-day overlap),
+        # older days in the window come from the existing file
+        existing = self.load_existing(window_start)
+        if existing:
+            last_sync = datetime.fromisoformat(existing['syncDate'])
+            start_date = max(window_start, (last_sync - timedelta(days=2)).strftime('%Y-%m-%d'))
         
         print(f"📥 Sincronizzazione dati Oura ({start_date} → {end_date})...")
         
         data = {
             'syncDate': datetime.now().isoformat(),
-            'startDate': start_date,
+            'startDate': window_start,
             'endDate': end_date,
             'sleep': [],
             'readiness': [],
@@ -214,78 +289,84 @@ class OuraSync:
             'daily': []
         }
         
-        # Fetch all data types
-        print("  📊 Sleep...")
-        data['sleep'] = self.fetch_data('daily_sleep', start_date, end_date)
+        # Fetch all data types concurrently (independent I/O-bound requests)
+        print("  📊 Sleep, ⚡ Readiness, 🚶 Activity, ❤️ Heart Rate...")
+        endpoints = ['daily_sleep', 'sleep', 'daily_readiness', 'daily_activity', 'heartrate']
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            results = list(executor.map(lambda ep: self.fetch_data(ep, start_date, end_date), endpoints))
+        data['sleep'], detailed_sleep, data['readiness'], data['activity'], data['heartrate'] = results
         
-        # Also fetch detailed sleep for HRV values
-        print("  📊 Sleep (dettagli HRV)...")
-        detailed_sleep = self.fetch_data('sleep', start_date, end_date)
+        # Detailed sleep provides the HRV values
         # Index by date for easy lookup
-        sleep_hrv = {}
-        for s in detailed_sleep:
-            day = s.get('day')
-            if day and s.get('average_hrv'):
-                # Take the most recent sleep session per day
-                if day not in sleep_hrv or s.get('bedtime_end', '') > sleep_hrv[day].get('bedtime_end', ''):
-                    sleep_hrv[day] = s
-        
-        print("  ⚡ Readiness...")
-        data['readiness'] = self.fetch_data('daily_readiness', start_date, end_date)
-        
-        print("  🚶 Activity...")
-        data['activity'] = self.fetch_data('daily_activity', start_date, end_date)
-        
-        print("  ❤️ Heart Rate...")
-        data['heartrate'] = self.fetch_data('heartrate', start_date, end_date)
+        # Take the most recent sleep session per day
+        with_hrv = sorted((s for s in detailed_sleep if s.get('day') and s.get('average_hrv')), key=itemgetter('day'))
+        sleep_hrv = {
+            day: max(group, key=lambda s: s.get('bedtime_end') or '')
+            for day, group in groupby(with_hrv, key=itemgetter('day'))
+        }
         
         # Process into daily summary
-        daily_data = {}
+        daily_data = defaultdict(dict)
         
         for sleep in data['sleep']:
             date = sleep.get('day')
             if date:
-                if date not in daily_data:
-                    daily_data[date] = {'date': date}
-                daily_data[date]['sleepScore'] = sleep.get('score')
-                daily_data[date]['totalSleep'] = sleep.get('contributors', {}).get('total_sleep')
-                daily_data[date]['deepSleep'] = sleep.get('contributors', {}).get('deep_sleep')
-                daily_data[date]['efficiency'] = sleep.get('contributors', {}).get('efficiency')
+                contrib = sleep.get('contributors') or {}
+                rec = daily_data[date]
+                rec['date'] = date
+                rec['sleepScore'] = sleep.get('score')
+                rec['totalSleep'] = contrib.get('total_sleep')
+                rec['deepSleep'] = contrib.get('deep_sleep')
+                rec['efficiency'] = contrib.get('efficiency')
                 # Get actual HRV from detailed sleep data
-                if date in sleep_hrv:
-                    daily_data[date]['hrv'] = sleep_hrv[date].get('average_hrv')
-                    daily_data[date]['lowestHR'] = sleep_hrv[date].get('lowest_heart_rate')
+                hrv_sleep = sleep_hrv.get(date)
+                if hrv_sleep:
+                    rec['hrv'] = hrv_sleep.get('average_hrv')
+                    rec['lowestHR'] = hrv_sleep.get('lowest_heart_rate')
         
         for readiness in data['readiness']:
             date = readiness.get('day')
             if date:
-                if date not in daily_data:
-                    daily_data[date] = {'date': date}
-                daily_data[date]['readinessScore'] = readiness.get('score')
+                contrib = readiness.get('contributors') or {}
+                rec = daily_data[date]
+                rec['date'] = date
+                rec['readinessScore'] = readiness.get('score')
                 # Only use hrv_balance as fallback if no average_hrv available
-                if 'hrv' not in daily_data[date]:
-                    daily_data[date]['hrv'] = readiness.get('contributors', {}).get('hrv_balance')
-                    daily_data[date]['hrvIsBalance'] = True  # Mark as balance score, not ms
-                daily_data[date]['hrvBalance'] = readiness.get('contributors', {}).get('hrv_balance')
-                daily_data[date]['recoveryIndex'] = readiness.get('contributors', {}).get('recovery_index')
-                daily_data[date]['restingHR'] = readiness.get('contributors', {}).get('resting_heart_rate')
+                if 'hrv' not in rec:
+                    rec['hrv'] = contrib.get('hrv_balance')
+                    rec['hrvIsBalance'] = True  # Mark as balance score, not ms
+                rec['hrvBalance'] = contrib.get('hrv_balance')
+                rec['recoveryIndex'] = contrib.get('recovery_index')
+                rec['restingHR'] = contrib.get('resting_heart_rate')
         
         for activity in data['activity']:
             date = activity.get('day')
             if date:
-                if date not in daily_data:
-                    daily_data[date] = {'date': date}
-                daily_data[date]['activityScore'] = activity.get('score')
-                daily_data[date]['activeCalories'] = activity.get('active_calories')
-                daily_data[date]['steps'] = activity.get('steps')
+                rec = daily_data[date]
+                rec['date'] = date
+                rec['activityScore'] = activity.get('score')
+                rec['activeCalories'] = activity.get('active_calories')
+                rec['steps'] = activity.get('steps')
         
         # Convert to list and sort
-        data['daily'] = sorted(daily_data.values(), key=lambda x: x['date'], reverse=True)
+        if existing:
+            def in_kept_range(item, key='day'):
+                day = (item.get(key) or '')[:10]
+                return window_start <= day < start_date
+            
+            for key in ('sleep', 'readiness', 'activity'):
+                data[key] = [x for x in existing.get(key, []) if in_kept_range(x)] + data[key]
+            data['heartrate'] = [x for x in existing.get('heartrate', []) if in_kept_range(x, 'timestamp')] + data['heartrate']
+            
+            merged = {r['date']: r for r in existing.get('daily', []) if r.get('date', '') >= window_start}
+            merged.update(daily_data)
+            daily_data = merged
+        
+        data['daily'] = sorted(daily_data.values(), key=itemgetter('date'), reverse=True)
         
         # Save to file
         os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        write_json(DATA_FILE, data)
         
         print(f"\n✅ Sincronizzati {len(data['daily'])} giorni di dati Oura")
         print(f"   File salvato: {DATA_FILE}")
@@ -5,29 +5,78 @@ For use in GitHub Actions - sends MFA prompt via Telegram
 """
 
 import os
+import re
 import sys
 import time
 import json
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Telegram Config (from environment/secrets)
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
+TELEGRAM_ENABLED = bool(TELEGRAM_TOKEN and TELEGRAM_CHAT_ID)
+TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+TELEGRAM_UPDATES_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
 
 # Garmin Config
 GARMIN_EMAIL = os.environ.get('GARMIN_EMAIL')
 GARMIN_PASSWORD = os.environ.get('GARMIN_PASSWORD')
 
+# MFA codes are 4-8 digits (usually 6)
+MFA_CODE_RE = re.compile(r"\d{4,8}")
+
+# Shared HTTP session: Telegram sends and getUpdates polls reuse one TLS connection
+SESSION = requests.Session()
+
+# Parallel activity downloads, capped by a shared rate limit
+DOWNLOAD_WORKERS = 4
+DOWNLOADS_PER_SECOND = 10
+
+
+class RateLimiter:
+    """Sliding-window rate limiter shared across download threads."""
+    
+    def __init__(self, max_calls, period=1.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= self.period:
+                self.calls.popleft()
+            if len(self.calls) >= self.max_calls:
+                time.sleep(self.period - (now - self.calls[0]))
+                self.calls.popleft()
+            self.calls.append(time.monotonic())
+
+
+# Status messages queued with send_telegram(..., batch=True), sent by flush_telegram()
+TELEGRAM_BUFFER = []
+
 
-def send_telegram(message):
-    """Send a message via Telegram bot."""
-    if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
+def send_telegram(message, batch=False):
+    """Send a message via Telegram bot (or queue it for flush_telegram if batch=True)."""
+    if batch:
+        TELEGRAM_BUFFER.append(message)
+        return True
+    
+    if not TELEGRAM_ENABLED:
         print("⚠️ Telegram not configured")
         return False
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     data = {
         "chat_id": TELEGRAM_CHAT_ID,
         "text": message,
@@ -35,26 +84,40 @@ def send_telegram(message):
     }
     
     try:
-        response = requests.post(url, json=data, timeout=10)
+        response = SESSION.post(TELEGRAM_SEND_URL, json=data, timeout=10)
         return response.ok
     except Exception as e:
         print(f"Telegram error: {e}")
         return False
 
 
-def get_telegram_updates(offset=None):
-    """Get recent messages from Telegram."""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
-    params = {"timeout": 30}
+def flush_telegram():
+    """Send all queued status messages as a single Telegram message."""
+    if not TELEGRAM_BUFFER:
+        return True
+    message = "\n\n".join(TELEGRAM_BUFFER)
+    TELEGRAM_BUFFER.clear()
+    return send_telegram(message)
+
+
+def get_telegram_updates(offset=None, poll_timeout=30):
+    """Get recent messages from Telegram (long poll: returns as soon as a message arrives)."""
+    if not TELEGRAM_ENABLED:
+        return []
+    
+    params = {"timeout": poll_timeout}
     if offset:
         params["offset"] = offset
     
     try:
-        response = requests.get(url, params=params, timeout=60)
+        response = SESSION.get(TELEGRAM_UPDATES_URL, params=params, timeout=poll_timeout + 5)
         if response.ok:
-            return response.json().get("result", [])
+            payload = orjson.loads(response.content) if orjson else response.json()
+            return payload.get("result", [])
     except Exception as e:
         print(f"Error getting updates: {e}")
+    # Avoid a busy loop when the API is failing
+    time.sleep(2)
     return []
 
 
@@ -63,14 +126,18 @@ def wait_for_mfa_code(timeout=300):
     Wait for MFA code via Telegram message.
     Polls for messages for up to `timeout` seconds.
     """
+    if not TELEGRAM_ENABLED:
+        print("⚠️ Telegram not configured, cannot receive MFA code")
+        return None
+    
     print("⏳ Waiting for MFA code via Telegram...")
     send_telegram("🔐 <b>Garmin MFA Required</b>\n\nPer favore rispondi con il codice MFA inviato da Garmin.\n\n⏱️ Timeout: 5 minuti")
     
     start_time = time.time()
     last_update_id = None
     
-    # Get current update_id to ignore old messages
-    updates = get_telegram_updates()
+    # Get current update_id to ignore old messages (no long poll here)
+    updates = get_telegram_updates(poll_timeout=0)
     if updates:
         last_update_id = updates[-1]["update_id"] + 1
     
@@ -82,15 +149,13 @@ def wait_for_mfa_code(timeout=300):
             
             if "message" in update:
                 text = update["message"].get("text", "").strip()
-                # Check if it looks like an MFA code (usually 6 digits)
-                if text.isdigit() and 4 <= len(text) <= 8:
+                # Check if it looks like an MFA code
+                if MFA_CODE_RE.fullmatch(text):
                     print(f"✅ MFA code received: {text[:2]}****")
-                    send_telegram(f"✅ Codice ricevuto! Procedo con il login...")
+                    send_telegram(f"✅ Codice ricevuto! Procedo con il login...", batch=True)
                     return text
-        
-        time.sleep(2)
     
-    send_telegram("❌ Timeout! Nessun codice MFA ricevuto.")
+    send_telegram("❌ Timeout! Nessun codice MFA ricevuto.", batch=True)
     return None
 
 
@@ -102,6 +167,32 @@ def telegram_mfa_prompt():
     return wait_for_mfa_code()
 
 
+def garmin_login(garth):
+    """
+    Resume the cached garth session from ~/.garth.
+    Falls back to a full login (with Telegram MFA) only when it is missing or rejected.
+    """
+    try:
+        garth.resume("~/.garth")
+        oauth2 = garth.client.oauth2_token
+        if oauth2 is not None and oauth2.expires_at < time.time() + 300:
+            garth.client.refresh_oauth2()
+            garth.save("~/.garth")
+        garth.client.username  # Validates the session against the API
+        print("✅ Resumed cached Garmin session")
+        return
+    except Exception as e:
+        print(f"ℹ️ No valid cached session ({e})")
+    
+    # Login with custom MFA handler
+    print("🔐 Logging in to Garmin Connect...")
+    garth.login(GARMIN_EMAIL, GARMIN_PASSWORD, prompt_mfa=telegram_mfa_prompt)
+    print("✅ Login successful!")
+    
+    # Save session for future use
+    garth.save("~/.garth")
+
+
 def sync_garmin():
     """Main sync function with historical data support."""
     import garth
@@ -114,20 +205,11 @@ def sync_garmin():
     print("🔄 Starting Garmin Sync...")
     print(f"📧 Email: {GARMIN_EMAIL}")
     
-    # Clear any cached sessions
-    garth_dir = os.path.expanduser("~/.garth")
-    if os.path.exists(garth_dir):
-        import shutil
-        shutil.rmtree(garth_dir)
+    # Back off on 429/5xx (honouring Retry-After) instead of sleeping between calls
+    garth.configure(retries=5, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504))
     
     try:
-        # Try to login with custom MFA handler
-        print("🔐 Logging in to Garmin Connect...")
-        garth.login(GARMIN_EMAIL, GARMIN_PASSWORD, prompt_mfa=telegram_mfa_prompt)
-        print("✅ Login successful!")
-        
-        # Save session for future use
-        garth.save("~/.garth")
+        garmin_login(garth)
         
         # Create Garmin client
         client = Garmin(GARMIN_EMAIL, GARMIN_PASSWORD)
@@ -137,56 +219,58 @@ def sync_garmin():
         data_dir = Path("data/activities")
         data_dir.mkdir(parents=True, exist_ok=True)
         
+        # Enumerate the archive once: used for first-run detection, skip checks and totals
+        # (os.scandir yields bare names: no Path object or stat per entry)
+        with os.scandir(data_dir) as entries:
+            existing_ids = frozenset(entry.name[:-4] for entry in entries if entry.name.endswith(".zip"))
+        
         # Check if we need historical sync
-        existing_files = list(data_dir.glob("*.zip"))
-        is_first_run = len(existing_files) < 10
+        is_first_run = len(existing_ids) < 10
         
         if is_first_run:
             print(f"\n📆 HISTORICAL SYNC: Downloading last {HISTORICAL_MONTHS} months...")
-            send_telegram(f"📆 <b>Sync Storico Attivato</b>\n\nScaricando tutte le attività degli ultimi {HISTORICAL_MONTHS} mesi...\n\n⏱️ Questo potrebbe richiedere alcuni minuti.")
+            send_telegram(f"📆 <b>Sync Storico</b>\nAttività degli ultimi {HISTORICAL_MONTHS} mesi.", batch=True)
             
             # Calculate date range
             end_date = datetime.now()
             start_date = end_date - timedelta(days=HISTORICAL_MONTHS * 30)
+            # startTimeLocal is "YYYY-MM-DD HH:MM:SS": same-format strings compare chronologically
+            start_date_str = start_date.strftime("%Y-%m-%d %H:%M:%S")
             
-            # Fetch ALL activities in batches
+            # Fetch ALL activities in batches; startDate/endDate make the server return
+            # only the activities in range, so a short page is the last one
             all_activities = []
             batch_size = 100
             start_idx = 0
+            date_params = {"startDate": start_date.strftime("%Y-%m-%d"), "endDate": end_date.strftime("%Y-%m-%d")}
             
             while True:
                 print(f"   Fetching batch {start_idx//batch_size + 1}...")
-                batch = client.get_activities(start_idx, batch_size)
+                batch = client.garth.connectapi(
+                    "/activitylist-service/activities/search/activities",
+                    params={"start": start_idx, "limit": batch_size, **date_params}
+                )
                 if not batch:
                     break
                 
                 all_activities.extend(batch)
+                if len(batch) < batch_size:
+                    break
                 
                 # Check if oldest activity is older than our target
                 oldest = batch[-1]
                 oldest_date_str = oldest.get("startTimeLocal", "")
-                if oldest_date_str:
-                    oldest_date = datetime.fromisoformat(oldest_date_str.replace("Z", ""))
-                    if oldest_date < start_date:
-                        print(f"   Reached {oldest_date.strftime('%Y-%m-%d')} - stopping")
-                        break
+                if oldest_date_str and oldest_date_str < start_date_str:
+                    print(f"   Reached {oldest_date_str[:10]} - stopping")
+                    break
                 
                 start_idx += batch_size
-                time.sleep(0.5)  # Rate limiting
             
             # Filter to only activities within date range
-            activities = []
-            for act in all_activities:
-                date_str = act.get("startTimeLocal", "")
-                if date_str:
-                    try:
-                        act_date = datetime.fromisoformat(date_str.replace("Z", ""))
-                        if act_date >= start_date:
-                            activities.append(act)
-                    except:
-                        activities.append(act)
-                else:
-                    activities.append(act)
+            activities = [
+                act for act in all_activities
+                if not act.get("startTimeLocal") or act["startTimeLocal"] >= start_date_str
+            ]
             
             print(f"📋 Found {len(activities)} activities in last {HISTORICAL_MONTHS} months")
         else:
@@ -200,35 +284,62 @@ def sync_garmin():
         skipped = 0
         errors = 0
         
-        for i, act in enumerate(activities):
-            activity_id = act.get("activityId")
-            if not activity_id:
+        to_download = {}  # Keyed by ID: paging can return the same activity twice
+        for act in activities:
+            raw_id = act.get("activityId")
+            if not raw_id:
                 continue
+            activity_id = str(raw_id)
             
-            fit_path = data_dir / f"{activity_id}.zip"
-            if fit_path.exists():
+            if activity_id in existing_ids:
                 skipped += 1
                 continue
-            
-            activity_name = act.get("activityName", "Unknown")[:30]
-            print(f"   📥 [{i+1}/{len(activities)}] {activity_name}...")
-            
+            fit_path = data_dir / f"{activity_id}.zip"
+            # "or": activities can carry an explicit null name
+            to_download[activity_id] = (fit_path, (act.get("activityName") or "Unknown")[:30])
+        
+        limiter = RateLimiter(DOWNLOADS_PER_SECOND)
+        
+        def download(activity_id, fit_path):
+            limiter.wait()
+            # Same endpoint as client.download_activity(ORIGINAL), streamed to disk in 64 KiB chunks
+            response = client.garth.request(
+                "GET", "connectapi", f"/download-service/files/activity/{activity_id}",
+                api=True, stream=True
+            )
+            # Write to a temp file and rename: a killed run never leaves a truncated ZIP behind
+            tmp_path = fit_path.with_suffix(".zip.tmp")
+            size = 0
             try:
-                zip_data = client.download_activity(
-                    activity_id, 
-                    dl_fmt=client.ActivityDownloadFormat.ORIGINAL
-                )
-                if zip_data:
-                    with open(fit_path, "wb") as f:
-                        f.write(zip_data)
+                with response, open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        f.write(chunk)
+                        size += len(chunk)
+                if size:
+                    os.replace(tmp_path, fit_path)
+            finally:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            # An empty 200 must not pass as downloaded: count it as an error
+            if not size:
+                raise ValueError("Download returned an empty file")
+        
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = {
+                executor.submit(download, activity_id, fit_path): activity_name
+                for activity_id, (fit_path, activity_name) in to_download.items()
+            }
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
                     downloaded += 1
-                time.sleep(0.3)  # Rate limiting
-            except Exception as e:
-                print(f"   ⚠️ Error: {e}")
-                errors += 1
+                    print(f"   📥 [{i+1}/{len(to_download)}] {futures[future]}")
+                except Exception as e:
+                    print(f"   ⚠️ Error: {futures[future]}: {e}")
+                    errors += 1
         
         # Summary
-        total_files = len(list(data_dir.glob("*.zip")))
+        total_files = len(existing_ids) + downloaded
         summary = f"""✅ <b>Garmin Sync Complete!</b>
 
 📥 Scaricate: {downloaded} nuove attività
@@ -239,13 +350,15 @@ def sync_garmin():
             summary += f"\n⚠️ Errori: {errors}"
         
         print(f"\n{summary.replace('<b>', '').replace('</b>', '')}")
-        send_telegram(summary)
+        send_telegram(summary, batch=True)
+        flush_telegram()
         return True
         
     except Exception as e:
         error_msg = str(e)
         print(f"❌ Sync failed: {error_msg}")
-        send_telegram(f"❌ <b>Garmin Sync Failed</b>\n\n{error_msg}")
+        send_telegram(f"❌ <b>Garmin Sync Failed</b>\n\n{error_msg}", batch=True)
+        flush_telegram()
         return False
 
 
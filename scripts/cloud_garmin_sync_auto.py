@@ -9,46 +9,421 @@ import sys
 import time
 import json
 import re
+import base64
+import quopri
 import imaplib
+import select
+import ssl
 import email
 from email.header import decode_header
+from email.parser import BytesHeaderParser
+from functools import lru_cache
+import shutil
+import threading
+import queue
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime, timedelta
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Faster whole-file JSON parsing when ijson is missing but orjson is available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Email Config (for reading MFA codes)
 EMAIL_ADDRESS = os.environ.get('MFA_EMAIL_ADDRESS')  # Gmail address
 EMAIL_PASSWORD = os.environ.get('MFA_EMAIL_PASSWORD')  # Gmail App Password
+EMAIL_OAUTH_TOKEN = os.environ.get('MFA_EMAIL_OAUTH_TOKEN')  # OAuth2 access token (XOAUTH2), preferred if set
 IMAP_SERVER = os.environ.get('IMAP_SERVER', 'imap.gmail.com')
 
 # Telegram Config (for notifications only)
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
 
+# Shared HTTP session: every Telegram notification reuses one TLS connection
+SESSION = requests.Session()
+
+# Notifications are posted by a background worker, in order, off the sync's critical path
+TELEGRAM_QUEUE = queue.Queue()
+TELEGRAM_WORKER = None
+
 # Garmin Config
 GARMIN_EMAIL = os.environ.get('GARMIN_EMAIL')
 GARMIN_PASSWORD = os.environ.get('GARMIN_PASSWORD')
 
+# garth session tokens, restored between GitHub Actions runs by actions/cache
+GARTH_DIR = "~/.garth"
+
+# Parallel activity downloads, capped by a shared rate limit
+DOWNLOAD_WORKERS = 5
+DOWNLOADS_PER_SECOND = 5
+
+# Regexes used to clean the MFA email body and extract the code
+# A run of HTML tags, &nbsp;, numeric entities and whitespace collapses to one space
+# (or to nothing if it is only numeric entities)
+BODY_SEPARATOR_RE = re.compile(r'(?:<[^>]+>|&nbsp;|&#\d+;|\s)+')
+HTML_ENTITIES_RE = re.compile(r'(?:&#\d+;)+')
+MFA_CODE_PATTERNS = [
+    re.compile(r'codice di sicurezza[^\d]*(\d{6})', re.IGNORECASE),  # Italian: after "codice di sicurezza"
+    re.compile(r'passcode[^\d]*(\d{6})', re.IGNORECASE),             # After "passcode"
+    re.compile(r'code[^\d]*(\d{6})', re.IGNORECASE),                 # After "code"
+]
+# Subject keywords of a passcode email ("code" also covers "passcode")
+MFA_SUBJECT_KEYWORDS = ('code', 'sicurezza', 'security')
+STANDALONE_CODE_RE = re.compile(r'\b(\d{6})\b')  # Any standalone 6-digit number
+# ASCII byte classes for find_standalone_code: 1 = digit, 2 = other word char, 0 = boundary
+CHAR_CLASS_TABLE = bytes(
+    1 if 48 <= b <= 57 else 2 if (65 <= b <= 90 or 97 <= b <= 122 or b == 95) else 0
+    for b in range(256)
+)
+SIX_DIGITS_RE = re.compile(r'\d{6}')
+SIX_DIGITS_BYTES_RE = re.compile(rb'\d{6}')  # Same check on the raw payload, before decoding
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+UIDNEXT_RE = re.compile(rb'UIDNEXT (\d+)')
+
+# Subject check plus MIME layout; MIME headers are kept for the full-body fallback
+MFA_HEADER_FETCH = '(BODY.PEEK[HEADER.FIELDS (SUBJECT MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] BODYSTRUCTURE)'
+HEADER_PARSER = BytesHeaderParser()  # Parsed once per candidate, reused by fetch_email_body
+BODYSTRUCTURE_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+
+class RateLimiter:
+    """Sliding-window rate limiter shared across download threads."""
+    
+    def __init__(self, max_calls, period=1.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= self.period:
+                self.calls.popleft()
+            if len(self.calls) >= self.max_calls:
+                time.sleep(self.period - (now - self.calls[0]))
+                self.calls.popleft()
+            self.calls.append(time.monotonic())
+
+
+def telegram_worker():
+    """Post queued Telegram notifications one at a time, in the order they were sent."""
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    while True:
+        message = TELEGRAM_QUEUE.get()
+        data = {
+            "chat_id": TELEGRAM_CHAT_ID,
+            "text": message,
+            "parse_mode": "HTML"
+        }
+        try:
+            response = SESSION.post(url, json=data, timeout=10)
+            if not response.ok:
+                print(f"Telegram error: {response.status_code}")
+        except Exception as e:
+            print(f"Telegram error: {e}")
+        finally:
+            TELEGRAM_QUEUE.task_done()
+
 
 def send_telegram(message):
-    """Send a notification via Telegram bot."""
+    """Queue a notification for the Telegram bot without waiting for the HTTP round-trip."""
+    global TELEGRAM_WORKER
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
         print("⚠️ Telegram not configured")
         return False
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    data = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": message,
-        "parse_mode": "HTML"
-    }
+    if TELEGRAM_WORKER is None:
+        TELEGRAM_WORKER = threading.Thread(target=telegram_worker, daemon=True)
+        TELEGRAM_WORKER.start()
+    TELEGRAM_QUEUE.put(message)
+    return True
+
+
+def flush_telegram():
+    """Wait until every queued notification has been posted."""
+    if TELEGRAM_WORKER is not None:
+        TELEGRAM_QUEUE.join()
+
+
+# Logged-in IMAP connections keyed by (host, user), reused while they stay alive
+IMAP_CONNECTIONS = {}
+
+
+def get_imap(host, user, password, oauth_token=None):
+    """
+    Return a logged-in IMAP connection, reusing the cached one if NOOP still succeeds.
+    Authenticates with SASL XOAUTH2 when an OAuth2 access token is given, else LOGIN.
+    """
+    mail = IMAP_CONNECTIONS.get((host, user))
+    if mail is not None:
+        try:
+            mail.noop()
+            return mail
+        except (imaplib.IMAP4.error, OSError):
+            IMAP_CONNECTIONS.pop((host, user), None)
     
+    mail = imaplib.IMAP4_SSL(host)
+    if oauth_token:
+        auth_string = f"user={user}\x01auth=Bearer {oauth_token}\x01\x01".encode()
+        mail.authenticate('XOAUTH2', lambda _: auth_string)
+    else:
+        mail.login(user, password)
+    IMAP_CONNECTIONS[(host, user)] = mail
+    return mail
+
+
+def close_imap_connections():
+    """Log out of all cached IMAP connections."""
+    for mail in IMAP_CONNECTIONS.values():
+        try:
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+    IMAP_CONNECTIONS.clear()
+
+
+@lru_cache(maxsize=64)
+def decode_subject(subject):
+    """Decode an RFC 2047 subject; plain subjects (no encoded words) are returned as-is."""
+    if not subject or '=?' not in subject:
+        return subject
+    decoded = decode_header(subject)[0]
+    if isinstance(decoded[0], bytes):
+        return decoded[0].decode(decoded[1] or 'utf-8')
+    return decoded[0]
+
+
+def parse_bodystructure(data):
+    """Parse the BODYSTRUCTURE s-expression at the start of `data` into nested lists."""
+    stack = [[]]
+    for token in BODYSTRUCTURE_TOKEN_RE.findall(data):
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) == 1:
+                break
+            closed = stack.pop()
+            if len(stack) == 1:
+                return closed
+            stack[-1].append(closed)
+        elif token.startswith(b'"'):
+            stack[-1].append(token[1:-1].replace(b'\\"', b'"').decode(errors='replace'))
+        else:
+            stack[-1].append(None if token.upper() == b'NIL' else token.decode(errors='replace'))
+    return None
+
+
+def iter_body_parts(structure, section=''):
+    """Yield (section, part) for every leaf MIME part of a parsed BODYSTRUCTURE."""
+    if structure and isinstance(structure[0], list):
+        children = []
+        for item in structure:
+            if not isinstance(item, list):
+                break
+            children.append(item)
+        for i, child in enumerate(children, 1):
+            yield from iter_body_parts(child, f"{section}.{i}" if section else str(i))
+    elif structure:
+        yield section or '1', structure
+
+
+def find_text_part(structure):
+    """Return (section, part) of the first text/plain part, else the first text/html part."""
+    html = None
+    for section, part in iter_body_parts(structure):
+        content_type = (str(part[0]).lower(), str(part[1]).lower())
+        if content_type == ('text', 'plain'):
+            return section, part
+        if content_type == ('text', 'html') and html is None:
+            html = (section, part)
+    return html
+
+
+def decode_part(payload, encoding, charset):
+    """Undo the transfer encoding of a fetched MIME part and decode it to text."""
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        payload = base64.b64decode(payload)
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    
+    # Digits are single bytes in ASCII-compatible charsets: a body with no 6-digit run
+    # (nor numeric entities that might split one) cannot carry the code, skip decoding it
+    if not (charset or '').lower().startswith(('utf-16', 'utf-32')):
+        if not SIX_DIGITS_BYTES_RE.search(payload) and b'&#' not in payload:
+            return ""
     try:
-        response = requests.post(url, json=data, timeout=10)
-        return response.ok
-    except Exception as e:
-        print(f"Telegram error: {e}")
+        return payload.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+def fetch_candidate_headers(mail, uids):
+    """
+    Fetch MFA_HEADER_FETCH for several UIDs in a single round-trip
+    (PEEK: the emails are not marked \\Seen).
+    Returns [(uid, header_bytes, response_meta)] sorted newest first.
+    """
+    status, msg_data = mail.uid('FETCH', b','.join(uids).decode(), MFA_HEADER_FETCH)
+    if status != 'OK':
+        return []
+    
+    # Each message has one literal (the headers); the bytes items that follow it
+    # carry the rest of that message's response (e.g. BODYSTRUCTURE)
+    messages = []
+    for item in msg_data:
+        if isinstance(item, tuple):
+            messages.append([item[0], item[1]])
+        elif messages and isinstance(item, bytes):
+            messages[-1][0] += item
+    
+    candidates = []
+    for response_meta, header_bytes in messages:
+        match = FETCH_UID_RE.search(response_meta)
+        if match:
+            candidates.append((match.group(1), header_bytes, response_meta))
+    candidates.sort(key=lambda c: int(c[0]), reverse=True)
+    return candidates
+
+
+def fetch_email_body(mail, email_id, response_meta, header_bytes, headers):
+    """
+    Fetch only the text/plain (or text/html) section located via BODYSTRUCTURE.
+    Falls back to the whole body and a MIME walk if the structure can't be used.
+    `headers` is the Message already parsed from `header_bytes`.
+    """
+    pos = response_meta.find(b'BODYSTRUCTURE ')
+    structure = parse_bodystructure(response_meta[pos + 14:]) if pos >= 0 else None
+    found = find_text_part(structure) if structure else None
+    if found:
+        section, part = found
+        params = part[2] if isinstance(part[2], list) else []
+        charset = next((params[i + 1] for i in range(0, len(params) - 1, 2)
+                        if str(params[i]).lower() == 'charset'), None)
+        status, msg_data = mail.uid('FETCH', email_id, f'(BODY.PEEK[{section}])')
+        if status == 'OK' and msg_data and isinstance(msg_data[0], tuple):
+            return decode_part(msg_data[0][1], part[5], charset)
+    
+    status, msg_data = mail.uid('FETCH', email_id, '(BODY.PEEK[TEXT])')
+    if status != 'OK':
+        return ""
+    
+    # Single-part email: the TEXT literal is the body, decode it as-is
+    if headers.get_content_maintype() != 'multipart':
+        return decode_part(msg_data[0][1], headers.get('Content-Transfer-Encoding'),
+                           headers.get_content_charset())
+    
+    # Multipart: first text/plain part, else the first text/html one (as find_text_part)
+    msg = email.message_from_bytes(header_bytes + msg_data[0][1])
+    body = ""
+    for part in msg.walk():
+        content_type = part.get_content_type()
+        if content_type == "text/plain":
+            try:
+                body = part.get_payload(decode=True).decode()
+                break
+            except:
+                continue
+        elif content_type == "text/html" and not body:
+            try:
+                body = part.get_payload(decode=True).decode()
+            except:
+                continue
+    return body
+
+
+def find_standalone_code(text):
+    """
+    Same result as STANDALONE_CODE_RE.search(text).group(1), as a byte-table scan:
+    translate() maps ASCII text to character classes and find() locates six digits
+    with a non-word character (or the edge) on both sides. Non-ASCII text uses the regex.
+    """
+    if not text.isascii():
+        match = STANDALONE_CODE_RE.search(text)
+        return match.group(1) if match else None
+    
+    data = text.encode('ascii')
+    marks = data.translate(CHAR_CLASS_TABLE)
+    i = marks.find(b'\x01' * 6)
+    while i >= 0:
+        end = i + 6
+        if (i == 0 or marks[i - 1] == 0) and (end == len(marks) or marks[end] == 0):
+            return data[i:end].decode('ascii')
+        i = marks.find(b'\x01' * 6, i + 1)
+    return None
+
+
+def clean_separator(match):
+    """Replacement for BODY_SEPARATOR_RE: drop bare entities, otherwise a single space."""
+    return '' if HTML_ENTITIES_RE.fullmatch(match.group(0)) else ' '
+
+
+def has_buffered_response(mail):
+    """
+    True if response bytes were already read past the socket: decrypted in the TLS
+    layer or sitting in imaplib's file buffer. select() only watches the socket and
+    would sleep through them.
+    """
+    if mail.sock.pending():
+        return True
+    # Non-blocking peek: returns buffered bytes (or whatever the socket has) without waiting
+    saved_timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
         return False
+    finally:
+        mail.sock.settimeout(saved_timeout)
+
+
+def wait_for_new_mail(mail, timeout):
+    """
+    Block in IMAP IDLE (RFC 2177) until the server pushes an EXISTS notification
+    or `timeout` seconds pass. Returns True if new mail arrived, False on timeout
+    and None if the server does not support IDLE.
+    """
+    # EXISTS pushed while the previous command ran: the mail is already there
+    if mail.untagged_responses.pop('EXISTS', None):
+        return True
+    
+    if 'IDLE' not in mail.capabilities:
+        return None
+    
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    if not mail.readline().startswith(b'+'):
+        return None
+    
+    deadline = time.time() + timeout
+    arrived = False
+    try:
+        while not arrived:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # EXISTS may have come in the same TLS record as the previous line
+            if not has_buffered_response(mail):
+                ready, _, _ = select.select([mail.sock], [], [], remaining)
+                if not ready:
+                    continue
+            arrived = b'EXISTS' in mail.readline()
+    finally:
+        # Leave IDLE and consume everything up to the tagged completion
+        mail.send(b'DONE\r\n')
+        while not mail.readline().startswith(tag):
+            pass
+    return arrived
 
 
 def read_mfa_from_email(timeout=180):
@@ -58,151 +433,127 @@ def read_mfa_from_email(timeout=180):
     """
     print("📧 Connecting to email to read MFA code...")
     
-    if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
+    if not EMAIL_ADDRESS or not (EMAIL_PASSWORD or EMAIL_OAUTH_TOKEN):
         print("❌ Email credentials not configured!")
         return None
     
     try:
         # Connect to Gmail IMAP
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        mail = get_imap(IMAP_SERVER, EMAIL_ADDRESS, EMAIL_PASSWORD, EMAIL_OAUTH_TOKEN)
         mail.select('INBOX')
         
+        # Only messages arriving after SELECT can carry the new code: UIDNEXT comes
+        # with the SELECT response (STATUS on the selected mailbox is discouraged)
+        uid_next_data = mail.untagged_responses.get('UIDNEXT')
+        if uid_next_data:
+            uid_next = int(uid_next_data[-1])
+        else:
+            status, data = mail.status('INBOX', '(UIDNEXT)')
+            uid_next = int(UIDNEXT_RE.search(data[0]).group(1))
+        # EXISTS from SELECT is not news: only later ones wake the IDLE wait
+        mail.untagged_responses.pop('EXISTS', None)
+        
         # FIRST: Delete ALL old Garmin MFA emails to avoid picking up old codes
         print("🧹 Cleaning old Garmin MFA emails...")
         try:
-            status, messages = mail.search(None, '(FROM "garmin")')
-            if status == 'OK' and messages[0]:
-                old_ids = messages[0].split()
-                for eid in old_ids:
-                    mail.store(eid, '+FLAGS', '\\Deleted')
+            # The sync runs daily: mail from the last 2 days covers everything since the
+            # previous run, without the server scanning the whole INBOX
+            since = (datetime.now() - timedelta(days=2)).strftime('%d-%b-%Y')
+            status, messages = mail.uid('SEARCH', None, f'(SINCE {since} FROM "garmin")')
+            # Mail that arrived after SELECT may already be the new code: keep it
+            old_ids = [uid for uid in messages[0].split() if int(uid) < uid_next] if status == 'OK' else []
+            if old_ids:
+                # One UID STORE over the whole set instead of a round-trip per message
+                mail.uid('STORE', b','.join(old_ids).decode(), '+FLAGS', '\\Deleted')
                 mail.expunge()
                 print(f"   Deleted {len(old_ids)} old Garmin emails")
         except Exception as e:
             print(f"   Could not clean old emails: {e}")
         
         start_time = time.time()
-        check_interval = 10  # Check every 10 seconds
+        check_interval = 10  # Poll every 10 seconds if the server lacks IDLE
+        idle_interval = 60  # Re-search at least once a minute while idling
         
         print(f"⏳ Waiting for NEW MFA email (timeout: {timeout}s)...")
         send_telegram("📧 <b>Garmin Sync Started</b>\n\nWaiting for NEW MFA email from Garmin...")
         
         while time.time() - start_time < timeout:
-            # Search for UNSEEN emails from Garmin (correct sender!)
-            # Note: Garmin uses alerts@account.garmin.com and Italian subject "Passcode di sicurezza"
-            search_strategies = [
-                '(UNSEEN FROM "alerts@account.garmin.com")',  # New unread from Garmin
-                '(FROM "alerts@account.garmin.com")',          # All from Garmin alerts
-                '(UNSEEN FROM "garmin")',                      # Any new from Garmin
-                '(FROM "garmin" SUBJECT "sicurezza")',         # Italian subject
-                '(FROM "garmin" SUBJECT "passcode")',          # English subject
-                '(FROM "garmin")',                             # Fallback: any from Garmin
-            ]
-            
+            # One UID SEARCH for new mail from Garmin (alerts@account.garmin.com,
+            # Italian subject "Passcode di sicurezza"); subject is filtered client-side
             email_ids = []
-            # Since we deleted all old Garmin emails, any email from the Garmin sender MUST be new
-            # Use simple search: if we find ANY email from Garmin security, it's the one we want
-            for criteria in search_strategies:
-                try:
-                    # Re-select inbox before each search to ensure fresh view
-                    mail.select('inbox')
-                    status, messages = mail.search(None, criteria)
-                    if status == 'OK' and messages[0]:
-                        email_ids = messages[0].split()
-                        print(f"   ✓ Found {len(email_ids)} emails with: {criteria}")
-                        break
-                    else:
-                        print(f"   No match for: {criteria}")
-                except Exception as e:
-                    print(f"   Search failed for {criteria}: {e}")
-                    continue
+            criteria = f'(UID {uid_next}:* FROM "garmin")'
+            try:
+                status, messages = mail.uid('SEARCH', None, criteria)
+                if status == 'OK' and messages[0]:
+                    # "n:*" always matches the last message: drop UIDs from before SELECT
+                    email_ids = [uid for uid in messages[0].split() if int(uid) >= uid_next]
+                if email_ids:
+                    print(f"   ✓ Found {len(email_ids)} emails with: {criteria}")
+                else:
+                    print(f"   No match for: {criteria}")
+            except Exception as e:
+                print(f"   Search failed for {criteria}: {e}")
             
             if email_ids:
-                email_ids = messages[0].split()
+                # Headers of the 5 most recent emails in one FETCH, checked newest first
+                try:
+                    candidates = fetch_candidate_headers(mail, email_ids[-5:])
+                    # Checked once: later rounds only search and fetch newer mail
+                    uid_next = max(map(int, email_ids)) + 1
+                except Exception as e:
+                    print(f"   Error fetching emails: {e}")
+                    candidates = []
                 
-                # Check most recent emails first
-                for email_id in reversed(email_ids[-5:]):
+                for email_id, header_bytes, response_meta in candidates:
                     try:
-                        status, msg_data = mail.fetch(email_id, '(RFC822)')
-                        if status != 'OK':
-                            continue
-                        
-                        msg = email.message_from_bytes(msg_data[0][1])
-                        
-                        # Check email date
-                        date_str = msg.get('Date', '')
+                        # Header-only parse: the fetched block has no body to scan
+                        msg = HEADER_PARSER.parsebytes(header_bytes)
                         
                         # Get subject
-                        subject = msg.get('Subject', '')
-                        if subject:
-                            decoded = decode_header(subject)[0]
-                            if isinstance(decoded[0], bytes):
-                                subject = decoded[0].decode(decoded[1] or 'utf-8')
-                            else:
-                                subject = decoded[0]
+                        subject = decode_subject(msg.get('Subject', ''))
                         
                         # Check if it's a passcode email (supports Italian and English)
-                        if 'passcode' not in subject.lower() and 'sicurezza' not in subject.lower() and 'security' not in subject.lower() and 'code' not in subject.lower():
+                        subject_lower = subject.lower()
+                        if not any(keyword in subject_lower for keyword in MFA_SUBJECT_KEYWORDS):
                             continue
                         
-                        # Get email body
-                        body = ""
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                if part.get_content_type() == "text/plain":
-                                    try:
-                                        body = part.get_payload(decode=True).decode()
-                                        break
-                                    except:
-                                        continue
-                                elif part.get_content_type() == "text/html":
-                                    try:
-                                        body = part.get_payload(decode=True).decode()
-                                    except:
-                                        continue
-                        else:
-                            try:
-                                body = msg.get_payload(decode=True).decode()
-                            except:
-                                body = str(msg.get_payload())
+                        # Passcode email: now fetch the body
+                        body = fetch_email_body(mail, email_id, response_meta, header_bytes, msg)
+                        
+                        # Every pattern needs a 6-digit run: skip the cleanup when there is none
+                        # (unless numeric entities, which are removed, might be splitting one)
+                        if not SIX_DIGITS_RE.search(body) and '&#' not in body:
+                            print("   No 6-digit code in email body")
+                            continue
                         
                         # Extract 6-digit code from body
                         # Clean HTML entities and tags for better extraction
-                        clean_body = re.sub(r'<[^>]+>', ' ', body)  # Remove HTML tags
-                        clean_body = re.sub(r'&nbsp;', ' ', clean_body)  # Replace nbsp
-                        clean_body = re.sub(r'&#\d+;', '', clean_body)  # Remove HTML entities
-                        clean_body = re.sub(r'\s+', ' ', clean_body)  # Normalize whitespace
+                        clean_body = BODY_SEPARATOR_RE.sub(clean_separator, body)
                         
                         # Debug: show snippet of body
                         print(f"   Email snippet: ...{clean_body[200:350]}..." if len(clean_body) > 350 else f"   Email: {clean_body}")
                         
                         # Try multiple patterns to find the 6-digit code
                         code = None
-                        patterns = [
-                            r'codice di sicurezza[^\d]*(\d{6})',  # Italian: after "codice di sicurezza"
-                            r'passcode[^\d]*(\d{6})',              # After "passcode"  
-                            r'code[^\d]*(\d{6})',                  # After "code"
-                            r'\b(\d{6})\b',                        # Any standalone 6-digit number
-                        ]
-                        
-                        for pattern in patterns:
-                            match = re.search(pattern, clean_body, re.IGNORECASE)
+                        for pattern in MFA_CODE_PATTERNS:
+                            match = pattern.search(clean_body)
                             if match:
                                 code = match.group(1)
-                                print(f"   Matched with pattern: {pattern}")
+                                print(f"   Matched with pattern: {pattern.pattern}")
                                 break
                         
+                        if code is None:
+                            code = find_standalone_code(clean_body)
+                            if code:
+                                print("   Matched standalone 6-digit number")
+                        
                         if code:
                             print(f"✅ Found MFA code: {code[:2]}****")
                             
-                            # Mark email as read
-                            mail.store(email_id, '+FLAGS', '\\Seen')
-                            
                             # Delete or archive the email to avoid reuse
-                            mail.store(email_id, '+FLAGS', '\\Deleted')
+                            mail.uid('STORE', email_id, '+FLAGS', '\\Deleted')
                             mail.expunge()
                             
-                            mail.logout()
                             send_telegram(f"✅ MFA code found automatically! Proceeding with sync...")
                             return code
                     
@@ -210,13 +561,19 @@ def read_mfa_from_email(timeout=180):
                         print(f"   Error reading email: {e}")
                         continue
             
-            # Wait before next check
-            time.sleep(check_interval)
+            # Wait for the server to push new mail (IDLE), or poll every check_interval
+            remaining = timeout - (time.time() - start_time)
+            if remaining <= 0:
+                break
+            arrived = wait_for_new_mail(mail, min(remaining, idle_interval))
+            if arrived is None:
+                time.sleep(min(remaining, check_interval))
             remaining = int(timeout - (time.time() - start_time))
-            if remaining % 30 == 0:
+            if arrived:
+                print(f"   New mail pushed by the server ({remaining}s remaining)")
+            else:
                 print(f"   Still waiting... {remaining}s remaining")
         
-        mail.logout()
         print("❌ Timeout: No MFA email found")
         send_telegram("❌ <b>MFA Timeout</b>\n\nNo passcode email received from Garmin within timeout.")
         return None
@@ -227,6 +584,61 @@ def read_mfa_from_email(timeout=180):
         return None
 
 
+def load_workouts_index(workouts_file):
+    """
+    Return (activity IDs, oldest start time) from workouts.json in a single read.
+    With ijson only the id and start_time fields are streamed, instead of loading
+    every activity.
+    """
+    with open(workouts_file, 'rb') as f:
+        if ijson:
+            ids, start_times = [], []
+            for prefix, _, value in ijson.parse(f):
+                if prefix == 'activities.item.id':
+                    ids.append(value)
+                elif prefix == 'activities.item.start_time':
+                    start_times.append(value)
+        else:
+            workouts = orjson.loads(f.read()) if orjson else json.load(f)
+            activities = workouts.get('activities', [])
+            del workouts
+            ids = [a.get('id') for a in activities]
+            start_times = [a.get('start_time') for a in activities]
+            del activities
+    
+    processed_ids = frozenset(str(i) for i in ids if i)
+    try:
+        oldest = min((datetime.fromisoformat(t) for t in start_times if t), default=None)
+    except (TypeError, ValueError) as e:
+        print(f"⚠️ Could not check date coverage: {e}")
+        oldest = None
+    return processed_ids, oldest
+
+
+def resume_garmin_session(garth):
+    """
+    Resume the garth tokens cached in ~/.garth.
+    Returns False (after clearing the stale cache) if they are missing or rejected.
+    """
+    garth_dir = os.path.expanduser(GARTH_DIR)
+    if not os.path.isdir(garth_dir):
+        return False
+    try:
+        garth.resume(garth_dir)
+        # Refresh a (nearly) expired OAuth2 token up front and cache it, so the next
+        # run resumes a fresh token instead of exchanging the OAuth1 one again
+        oauth2 = garth.client.oauth2_token
+        if oauth2 is not None and oauth2.expires_at < time.time() + 300:
+            garth.client.refresh_oauth2()
+            garth.save(garth_dir)
+        garth.client.username  # Validates the session against the API
+        return True
+    except Exception as e:
+        print(f"ℹ️ Cached Garmin session not valid ({e}), logging in again")
+        shutil.rmtree(garth_dir, ignore_errors=True)
+        return False
+
+
 def sync_garmin():
     """Main sync function with automatic email MFA."""
     import garth
@@ -239,39 +651,42 @@ def sync_garmin():
     print(f"📧 MFA Email: {EMAIL_ADDRESS}")
     print(f"🏃 Garmin: {GARMIN_EMAIL}")
     
-    # Clear any cached sessions
-    garth_dir = os.path.expanduser("~/.garth")
-    if os.path.exists(garth_dir):
-        import shutil
-        shutil.rmtree(garth_dir)
+    # Back off on 429/5xx (honouring Retry-After) instead of sleeping between pages
+    garth.configure(retries=5, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504))
     
     try:
-        # Login with automatic email MFA using return_on_mfa approach
-        # Per garth docs: login() returns ("needs_mfa", state) if MFA required, or (oauth1, oauth2) if not
-        print("🔐 Logging in to Garmin Connect...")
-        result1, result2 = garth.login(GARMIN_EMAIL, GARMIN_PASSWORD, return_on_mfa=True)
-        
-        if result1 == "needs_mfa":
-            # MFA is required - Garmin has now SENT the email
-            print("📧 MFA required - waiting for email from Garmin...")
+        if resume_garmin_session(garth):
+            print("✅ Resumed cached Garmin session (no MFA needed)")
+        else:
+            # Login with automatic email MFA using return_on_mfa approach
+            # Per garth docs: login() returns ("needs_mfa", state) if MFA required, or (oauth1, oauth2) if not
+            print("🔐 Logging in to Garmin Connect...")
+            result1, result2 = garth.login(GARMIN_EMAIL, GARMIN_PASSWORD, return_on_mfa=True)
             
-            # Step 2: Read the MFA code from email (now that it was sent)
-            mfa_code = read_mfa_from_email(timeout=180)
+            if result1 == "needs_mfa":
+                # MFA is required - Garmin has now SENT the email
+                print("📧 MFA required - waiting for email from Garmin...")
             
-            if not mfa_code:
-                raise Exception("Failed to get MFA code from email")
+                # Step 2: Read the MFA code from email (now that it was sent)
+                mfa_code = read_mfa_from_email(timeout=180)
             
-            # Step 3: Resume login with the state from login() AND the MFA code
-            # Use garth.client.resume_login which sets tokens internally
-            print(f"🔑 Submitting MFA code...")
-            garth.client.resume_login(result2, mfa_code)
-            print("✅ Login successful with MFA!")
-        else:
-            # Login succeeded without MFA - result1, result2 are oauth1, oauth2 tokens
-            print("✅ Login successful (no MFA required)!")
-        
-        # Skip session save - not needed in ephemeral GitHub Actions environment
-        # and garth.save() causes "Object of type Client is not JSON serializable" error
+                if not mfa_code:
+                    raise Exception("Failed to get MFA code from email")
+            
+                # Step 3: Resume login with the state from login() AND the MFA code
+                # Use garth.client.resume_login which sets tokens internally
+                print(f"🔑 Submitting MFA code...")
+                garth.client.resume_login(result2, mfa_code)
+                print("✅ Login successful with MFA!")
+            else:
+                # Login succeeded without MFA - result1, result2 are oauth1, oauth2 tokens
+                print("✅ Login successful (no MFA required)!")
+            
+            # Persist tokens for the next run (~/.garth is kept by the workflow cache)
+            try:
+                garth.save(GARTH_DIR)
+            except Exception as e:
+                print(f"⚠️ Could not save Garmin session: {e}")
         
         # Use garth directly for API calls (no need for Garmin wrapper which causes serialization issues)
         print("📡 Fetching activities from Garmin Connect...")
@@ -283,15 +698,12 @@ def sync_garmin():
         # Check workouts.json for already processed activity IDs
         # This persists across runs since workouts.json IS committed to the repo
         workouts_file = Path("data/workouts.json")
-        processed_ids = set()
+        processed_ids = frozenset()
+        oldest = None
         
         if workouts_file.exists():
             try:
-                with open(workouts_file, 'r') as f:
-                    workouts_data = json.load(f)
-                    for activity in workouts_data.get('activities', []):
-                        if activity.get('id'):
-                            processed_ids.add(str(activity['id']))
+                processed_ids, oldest = load_workouts_index(workouts_file)
                 print(f"📋 Found {len(processed_ids)} already processed activities in workouts.json")
             except Exception as e:
                 print(f"⚠️ Could not read workouts.json: {e}")
@@ -303,23 +715,15 @@ def sync_garmin():
         force_historical = os.environ.get('FORCE_HISTORICAL_SYNC', '').lower() == 'true'
         is_first_run = len(processed_ids) < 10
         
-        # Check date coverage from workouts.json activities
+        # Check date coverage from workouts.json activities (oldest read together with the IDs)
         needs_historical = False
-        if workouts_file.exists() and not is_first_run:
+        if oldest is not None and not is_first_run:
             try:
-                with open(workouts_file, 'r') as f:
-                    workouts_data = json.load(f)
-                    activities_list = workouts_data.get('activities', [])
-                    if activities_list:
-                        from datetime import timedelta
-                        dates = [datetime.fromisoformat(a['start_time']) for a in activities_list if a.get('start_time')]
-                        if dates:
-                            oldest = min(dates)
-                            days_covered = (datetime.now() - oldest).days
-                            print(f"📊 Current data covers {days_covered} days (from {oldest.strftime('%Y-%m-%d')})")
-                            if days_covered < 330:  # Less than ~11 months
-                                print(f"⚠️ Need to fetch more historical data to cover full year")
-                                needs_historical = True
+                days_covered = (datetime.now() - oldest).days
+                print(f"📊 Current data covers {days_covered} days (from {oldest.strftime('%Y-%m-%d')})")
+                if days_covered < 330:  # Less than ~11 months
+                    print(f"⚠️ Need to fetch more historical data to cover full year")
+                    needs_historical = True
             except Exception as e:
                 print(f"⚠️ Could not check date coverage: {e}")
         
@@ -333,32 +737,36 @@ def sync_garmin():
             start_idx = 0
             batch_size = 100
             max_days_back = HISTORICAL_MONTHS * 30
+            now = datetime.now()  # One reference time for the whole paging loop
+            # startTimeLocal starts with "YYYY-MM-DD": same-format day strings compare chronologically
+            cutoff_day = (now - timedelta(days=max_days_back)).strftime('%Y-%m-%d')
+            # The server filters by date range, so a short page is the last one
+            date_params = {"startDate": cutoff_day, "endDate": now.strftime('%Y-%m-%d')}
             
             while True:
                 print(f"   Fetching batch {start_idx//batch_size + 1}...")
                 # Use garth.connectapi directly
                 activities_response = garth.connectapi(
                     f"/activitylist-service/activities/search/activities",
-                    params={"start": start_idx, "limit": batch_size}
+                    params={"start": start_idx, "limit": batch_size, **date_params}
                 )
                 if not activities_response:
                     break
                 
                 all_activities.extend(activities_response)
+                if len(activities_response) < batch_size:
+                    break
                 
                 # Check if we've gone back far enough
                 if activities_response:
                     oldest = activities_response[-1]
                     oldest_date_str = oldest.get("startTimeLocal", "")
-                    if oldest_date_str:
-                        oldest_date = datetime.fromisoformat(oldest_date_str.replace("Z", ""))
-                        days_back = (datetime.now() - oldest_date).days
-                        if days_back >= max_days_back:
-                            print(f"   Reached {oldest_date.strftime('%Y-%m-%d')} ({days_back} days back) - stopping")
-                            break
+                    if oldest_date_str and oldest_date_str[:10] <= cutoff_day:
+                        days_back = (now - datetime.strptime(oldest_date_str[:10], '%Y-%m-%d')).days
+                        print(f"   Reached {oldest_date_str[:10]} ({days_back} days back) - stopping")
+                        break
                 
                 start_idx += batch_size
-                time.sleep(0.5)
             
             activities = all_activities
             print(f"📋 Found {len(activities)} activities in Garmin")
@@ -377,40 +785,70 @@ def sync_garmin():
         skipped = 0
         errors = 0
         
-        for i, act in enumerate(activities):
-            activity_id = str(act.get("activityId"))
-            if not activity_id:
+        # One directory scan: skips ZIPs left by a run that crashed before processing,
+        # and gives the archive total without re-scanning at the end
+        with os.scandir(data_dir) as entries:
+            existing_zip_ids = frozenset(entry.name[:-4] for entry in entries if entry.name.endswith(".zip"))
+        
+        to_download = {}  # Keyed by ID: paging can return the same activity twice
+        for act in activities:
+            raw_id = act.get("activityId")
+            if not raw_id:
                 continue
+            activity_id = str(raw_id)
             
-            # Skip if already processed (in workouts.json)
-            if activity_id in processed_ids:
+            # Skip if already processed (in workouts.json) or already downloaded
+            if activity_id in processed_ids or activity_id in existing_zip_ids:
                 skipped += 1
                 continue
             
-            fit_path = data_dir / f"{activity_id}.zip"
-            
-            activity_name = act.get("activityName", "Unknown")[:30]
-            print(f"   📥 [{i+1}/{len(activities)}] {activity_name}...")
-            
-            try:
-                # Download using garth - direct URL to get original FIT file
-                download_url = f"/download-service/files/activity/{activity_id}"
-                response = garth.client.get("connectapi", download_url)
-                if response and response.status_code == 200:
-                    zip_data = response.content
-                    with open(fit_path, "wb") as f:
-                        f.write(zip_data)
-                    downloaded += 1
-                else:
-                    print(f"   ⚠️ Download returned status {response.status_code if response else 'None'}")
+            # "or": activities can carry an explicit null name
+            to_download[activity_id] = (act.get("activityName") or "Unknown")[:30]
+        
+        limiter = RateLimiter(DOWNLOADS_PER_SECOND)
+        
+        def download(activity_id):
+            limiter.wait()
+            # Download using garth - direct URL to get original FIT file
+            download_url = f"/download-service/files/activity/{activity_id}"
+            response = garth.client.get("connectapi", download_url, stream=True)
+            if response and response.status_code == 200:
+                # Stream to a temp file and rename: bounded memory, no partial ZIPs on crash
+                fit_path = data_dir / f"{activity_id}.zip"
+                tmp_path = fit_path.with_suffix(".zip.tmp")
+                size = 0
+                try:
+                    with response, open(tmp_path, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=65536):
+                            f.write(chunk)
+                            size += len(chunk)
+                    if size:
+                        os.replace(tmp_path, fit_path)
+                finally:
+                    if tmp_path.exists():
+                        tmp_path.unlink()
+                # An empty 200 must not leave a 0-byte ZIP that would be skipped as downloaded
+                return None if size else "Download returned an empty file"
+            return f"Download returned status {response.status_code if response else 'None'}"
+        
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = {executor.submit(download, activity_id): activity_name
+                       for activity_id, activity_name in to_download.items()}
+            for i, future in enumerate(as_completed(futures)):
+                print(f"   📥 [{i+1}/{len(to_download)}] {futures[future]}")
+                try:
+                    error = future.result()
+                    if error:
+                        print(f"   ⚠️ {futures[future]}: {error}")
+                        errors += 1
+                    else:
+                        downloaded += 1
+                except Exception as e:
+                    print(f"   ⚠️ Error: {e}")
                     errors += 1
-                time.sleep(0.3)
-            except Exception as e:
-                print(f"   ⚠️ Error: {e}")
-                errors += 1
         
         # Summary
-        total_files = len(list(data_dir.glob("*.zip")))
+        total_files = len(existing_zip_ids) + downloaded
         summary = f"""✅ <b>Garmin Sync Complete!</b>
 
 📥 Downloaded: {downloaded} new activities
@@ -434,12 +872,18 @@ def sync_garmin():
 
 
 if __name__ == "__main__":
-    required = ['MFA_EMAIL_ADDRESS', 'MFA_EMAIL_PASSWORD', 'GARMIN_EMAIL', 'GARMIN_PASSWORD']
+    required = ['MFA_EMAIL_ADDRESS', 'GARMIN_EMAIL', 'GARMIN_PASSWORD']
     missing = [v for v in required if not os.environ.get(v)]
+    if not EMAIL_PASSWORD and not EMAIL_OAUTH_TOKEN:
+        missing.append('MFA_EMAIL_PASSWORD (or MFA_EMAIL_OAUTH_TOKEN)')
     
     if missing:
         print(f"❌ Missing environment variables: {', '.join(missing)}")
         sys.exit(1)
     
-    success = sync_garmin()
+    try:
+        success = sync_garmin()
+    finally:
+        flush_telegram()
+        close_imap_connections()
     sys.exit(0 if success else 1)
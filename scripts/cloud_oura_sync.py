@@ -6,10 +6,20 @@ Syncs Oura data using OAuth tokens from environment
 
 import os
 import json
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Faster JSON encode/decode when orjson is available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Config from environment
 OURA_ACCESS_TOKEN = os.environ.get('OURA_ACCESS_TOKEN')
 OURA_REFRESH_TOKEN = os.environ.get('OURA_REFRESH_TOKEN')
@@ -21,43 +31,73 @@ OURA_TOKEN_URL = 'https://api.ouraring.com/oauth/token'
 
 DATA_FILE = Path('data/oura.json')
 
+# One keep-alive session for token refresh and all API endpoints
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
 
-def refresh_token():
-    """Refresh OAuth token if needed."""
-    global OURA_ACCESS_TOKEN
-    
-    response = requests.post(OURA_TOKEN_URL, data={
-        'grant_type': 'refresh_token',
-        'refresh_token': OURA_REFRESH_TOKEN,
-        'client_id': OURA_CLIENT_ID,
-        'client_secret': OURA_CLIENT_SECRET
-    })
-    
-    if response.ok:
-        tokens = response.json()
-        OURA_ACCESS_TOKEN = tokens['access_token']
-        print("✅ Token refreshed")
-        return True
+# Endpoints are fetched concurrently: only one thread at a time refreshes the token
+TOKEN_LOCK = threading.Lock()
+
+
+def write_json(path, obj):
+    """Write obj as indented JSON."""
+    if orjson:
+        path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
     else:
-        print(f"❌ Token refresh failed: {response.text}")
-        return False
+        with open(path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+
+def set_access_token(access_token):
+    """Store the access token and set the Authorization header once on the session."""
+    global OURA_ACCESS_TOKEN
+    OURA_ACCESS_TOKEN = access_token
+    SESSION.headers['Authorization'] = f'Bearer {access_token}'
+
+
+def refresh_token(expired_token=None):
+    """Refresh OAuth token if needed."""
+    with TOKEN_LOCK:
+        # Another thread already replaced the token that was rejected
+        if expired_token and OURA_ACCESS_TOKEN != expired_token:
+            return True
+        
+        response = SESSION.post(OURA_TOKEN_URL, data={
+            'grant_type': 'refresh_token',
+            'refresh_token': OURA_REFRESH_TOKEN,
+            'client_id': OURA_CLIENT_ID,
+            'client_secret': OURA_CLIENT_SECRET
+        })
+        
+        if response.ok:
+            tokens = response.json()
+            set_access_token(tokens['access_token'])
+            print("✅ Token refreshed")
+            return True
+        else:
+            print(f"❌ Token refresh failed: {response.text}")
+            return False
 
 
 def fetch_data(endpoint, start_date, end_date):
     """Fetch data from Oura API."""
-    headers = {'Authorization': f'Bearer {OURA_ACCESS_TOKEN}'}
     params = {'start_date': start_date, 'end_date': end_date}
     
-    response = requests.get(f"{OURA_API_BASE}/{endpoint}", headers=headers, params=params)
+    token = OURA_ACCESS_TOKEN
+    response = SESSION.get(f"{OURA_API_BASE}/{endpoint}", params=params)
     
     if response.status_code == 401:
         # Token expired, try refresh
-        if refresh_token():
-            headers = {'Authorization': f'Bearer {OURA_ACCESS_TOKEN}'}
-            response = requests.get(f"{OURA_API_BASE}/{endpoint}", headers=headers, params=params)
+        if refresh_token(token):
+            response = SESSION.get(f"{OURA_API_BASE}/{endpoint}", params=params)
     
     if response.ok:
-        return response.json().get('data', [])
+        payload = orjson.loads(response.content) if orjson else response.json()
+        return payload.get('data', [])
     else:
         print(f"⚠️ Error fetching {endpoint}: {response.status_code}")
         return []
@@ -82,24 +122,21 @@ def sync_oura():
         'daily': []
     }
     
-    # Fetch all data types
-    print("  📊 Fetching sleep...")
-    data['sleep'] = fetch_data('daily_sleep', start_date, end_date)
+    # Fetch all data types concurrently (independent I/O-bound requests)
+    print("  📊 Fetching sleep, detailed sleep (HRV), ⚡ readiness, 🚶 activity...")
+    endpoints = ['daily_sleep', 'sleep', 'daily_readiness', 'daily_activity']
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        results = list(executor.map(lambda ep: fetch_data(ep, start_date, end_date), endpoints))
+    data['sleep'], detailed_sleep, data['readiness'], data['activity'] = results
     
-    print("  📊 Fetching detailed sleep (HRV)...")
-    detailed_sleep = fetch_data('sleep', start_date, end_date)
+    # Most recent sleep session with HRV per day, stored as (bedtime_end, session)
+    # so each comparison reads the cached bedtime_end
     sleep_hrv = {}
-    for s in detailed_sleep:
-        day = s.get('day')
-        if day and s.get('average_hrv'):
-            if day not in sleep_hrv or s.get('bedtime_end', '') > sleep_hrv[day].get('bedtime_end', ''):
-                sleep_hrv[day] = s
-    
-    print("  ⚡ Fetching readiness...")
-    data['readiness'] = fetch_data('daily_readiness', start_date, end_date)
-    
-    print("  🚶 Fetching activity...")
-    data['activity'] = fetch_data('daily_activity', start_date, end_date)
+    for s in [s for s in detailed_sleep if s.get('day') and s.get('average_hrv')]:
+        bedtime_end = s.get('bedtime_end') or ''
+        latest = sleep_hrv.get(s['day'])
+        if latest is None or bedtime_end > latest[0]:
+            sleep_hrv[s['day']] = (bedtime_end, s)
     
     # Process into daily summary
     daily_data = {}
@@ -107,44 +144,44 @@ def sync_oura():
     for sleep in data['sleep']:
         date = sleep.get('day')
         if date:
-            if date not in daily_data:
-                daily_data[date] = {'date': date}
-            daily_data[date]['sleepScore'] = sleep.get('score')
-            daily_data[date]['totalSleep'] = sleep.get('contributors', {}).get('total_sleep')
-            daily_data[date]['deepSleep'] = sleep.get('contributors', {}).get('deep_sleep')
-            daily_data[date]['efficiency'] = sleep.get('contributors', {}).get('efficiency')
+            entry = daily_data.setdefault(date, {'date': date})
+            contrib = sleep.get('contributors') or {}
+            entry['sleepScore'] = sleep.get('score')
+            entry['totalSleep'] = contrib.get('total_sleep')
+            entry['deepSleep'] = contrib.get('deep_sleep')
+            entry['efficiency'] = contrib.get('efficiency')
             if date in sleep_hrv:
-                daily_data[date]['hrv'] = sleep_hrv[date].get('average_hrv')
-                daily_data[date]['lowestHR'] = sleep_hrv[date].get('lowest_heart_rate')
+                hrv_sleep = sleep_hrv[date][1]
+                entry['hrv'] = hrv_sleep.get('average_hrv')
+                entry['lowestHR'] = hrv_sleep.get('lowest_heart_rate')
     
     for readiness in data['readiness']:
         date = readiness.get('day')
         if date:
-            if date not in daily_data:
-                daily_data[date] = {'date': date}
-            daily_data[date]['readinessScore'] = readiness.get('score')
-            if 'hrv' not in daily_data[date]:
-                daily_data[date]['hrv'] = readiness.get('contributors', {}).get('hrv_balance')
-                daily_data[date]['hrvIsBalance'] = True
-            daily_data[date]['hrvBalance'] = readiness.get('contributors', {}).get('hrv_balance')
-            daily_data[date]['recoveryIndex'] = readiness.get('contributors', {}).get('recovery_index')
-            daily_data[date]['restingHR'] = readiness.get('contributors', {}).get('resting_heart_rate')
+            entry = daily_data.setdefault(date, {'date': date})
+            contrib = readiness.get('contributors') or {}
+            entry['readinessScore'] = readiness.get('score')
+            if 'hrv' not in entry:
+                entry['hrv'] = contrib.get('hrv_balance')
+                entry['hrvIsBalance'] = True
+            entry['hrvBalance'] = contrib.get('hrv_balance')
+            entry['recoveryIndex'] = contrib.get('recovery_index')
+            entry['restingHR'] = contrib.get('resting_heart_rate')
     
     for activity in data['activity']:
         date = activity.get('day')
         if date:
-            if date not in daily_data:
-                daily_data[date] = {'date': date}
-            daily_data[date]['activityScore'] = activity.get('score')
-            daily_data[date]['activeCalories'] = activity.get('active_calories')
-            daily_data[date]['steps'] = activity.get('steps')
+            entry = daily_data.setdefault(date, {'date': date})
+            entry['activityScore'] = activity.get('score')
+            entry['activeCalories'] = activity.get('active_calories')
+            entry['steps'] = activity.get('steps')
     
-    data['daily'] = sorted(daily_data.values(), key=lambda x: x['date'], reverse=True)
+    # Days are the dict keys: sort them directly instead of calling a key function per entry
+    data['daily'] = [daily_data[date] for date in sorted(daily_data, reverse=True)]
     
     # Save
     DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+    write_json(DATA_FILE, data)
     
     print(f"\n✅ Oura sync complete! {len(data['daily'])} days saved.")
     return True
@@ -155,4 +192,5 @@ if __name__ == "__main__":
         print("❌ Missing OURA_ACCESS_TOKEN")
         exit(1)
     
+    set_access_token(OURA_ACCESS_TOKEN)
     sync_oura()
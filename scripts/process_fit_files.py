@@ -7,37 +7,242 @@ Extracts data from .zip files, calculates TSS, and outputs to JSON.
 import os
 import sys
 import json
+import array
+import pickle
+import struct
 import zipfile
+from multiprocessing import Pool
 from pathlib import Path
 from datetime import datetime, timedelta
 from collections import defaultdict
+from functools import lru_cache
 
-# Try to import fitparse
+import numpy as np
+
+# FIT protocol constants (only session and record messages are decoded)
+FIT_EPOCH = datetime(1989, 12, 31)
+FIT_SESSION = 18
+FIT_RECORD = 20
+
+# Base type -> (struct format, size, invalid value); floats use NaN as invalid.
+# Unknown base types are treated as plain bytes.
+FIT_BASE_TYPES = {
+    0x00: ('B', 1, 0xFF),                # enum
+    0x01: ('b', 1, 0x7F),                # sint8
+    0x02: ('B', 1, 0xFF),                # uint8
+    0x83: ('h', 2, 0x7FFF),              # sint16
+    0x84: ('H', 2, 0xFFFF),              # uint16
+    0x85: ('i', 4, 0x7FFFFFFF),          # sint32
+    0x86: ('I', 4, 0xFFFFFFFF),          # uint32
+    0x88: ('f', 4, None),                # float32
+    0x89: ('d', 8, None),                # float64
+    0x0A: ('B', 1, 0),                   # uint8z
+    0x8B: ('H', 2, 0),                   # uint16z
+    0x8C: ('I', 4, 0),                   # uint32z
+    0x8E: ('q', 8, 0x7FFFFFFFFFFFFFFF),  # sint64
+    0x8F: ('Q', 8, 0xFFFFFFFFFFFFFFFF),  # uint64
+    0x90: ('Q', 8, 0),                   # uint64z
+}
+
+FIT_SESSION_SPORT = 5
+FIT_SESSION_CADENCE = 18
+
+
+def fit_timestamp(value):
+    """Convert an absolute FIT timestamp to ISO format (None when unset)."""
+    if not value:
+        return None
+    if value < 0x10000000:
+        raise ValueError(f"Relative start_time {value}")
+    return (FIT_EPOCH + timedelta(seconds=value)).isoformat()
+
+
+# Session field number -> (activity key, conversion of the raw value).
+# Sport is handled apart: field 18 is avg_running_cadence for running sessions.
+SESSION_FIELDS = {
+    2: ('start_time', fit_timestamp),
+    7: ('duration', lambda v: int(v / 1000) if v else 0),
+    9: ('distance', lambda v: round(v / 100 / 1000, 2) if v else 0.0),
+    11: ('calories', lambda v: int(v) if v else 0),
+    14: ('avg_speed', lambda v: float(v / 1000) if v else None),
+    16: ('avg_hr', lambda v: int(v) if v else None),
+    17: ('max_hr', lambda v: int(v) if v else None),
+    18: ('avg_cadence', lambda v: int(v) if v else None),
+    20: ('avg_power', lambda v: int(v) if v else None),
+    21: ('max_power', lambda v: int(v) if v else None),
+    22: ('elevation_gain', lambda v: int(v) if v else 0),
+    34: ('normalized_power', lambda v: int(v) if v else None),
+    # Valid TSS from device usually preferred, but user reported issues.
+    # Using our formula for consistency unless 0.
+    35: ('tss', lambda v: round(v / 10, 1) if v and v / 10 > 10 else None),
+    124: ('avg_speed', lambda v: float(v / 1000) if v else None),
+}
+
+# Field numbers decoded per message; every other field is skipped
+FIT_FIELDS = {
+    FIT_SESSION: frozenset(SESSION_FIELDS) | {FIT_SESSION_SPORT},
+    FIT_RECORD: frozenset((3, 4, 7)),
+}
+
+# FIT sport enum (profile order), translated by get_sport_label
+FIT_SPORTS = dict(enumerate((
+    'generic', 'running', 'cycling', 'transition', 'fitness_equipment', 'swimming',
+    'basketball', 'soccer', 'tennis', 'american_football', 'training', 'walking',
+    'cross_country_skiing', 'alpine_skiing', 'snowboarding', 'rowing', 'mountaineering',
+    'hiking', 'multisport', 'paddling', 'flying', 'e_biking', 'motorcycling', 'boating',
+    'driving', 'golf', 'hang_gliding', 'horseback_riding', 'hunting', 'fishing',
+    'inline_skating', 'rock_climbing', 'sailing', 'ice_skating', 'sky_diving',
+    'snowshoeing', 'snowmobiling', 'stand_up_paddleboarding', 'surfing', 'wakeboarding',
+    'water_skiing', 'kayaking', 'rafting', 'windsurfing', 'kitesurfing', 'tactical',
+    'jumpmaster', 'boxing', 'floor_climbing',
+)))
+FIT_SPORT_RUNNING = 1
+
+# Optional: scipy runs the CTL/ATL recurrences in C
 try:
-    from fitparse import FitFile
+    from scipy.signal import lfilter
 except ImportError:
-    print("⚠️ fitparse not installed, installing...")
-    os.system("pip install fitparse")
-    from fitparse import FitFile
+    lfilter = None
+
+# Optional: pandas aggregates the daily TSS
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Faster JSON encode/decode when orjson is available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: pyarrow keeps the full activity cache as Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Parquet cache columns, in activity key order. Explicit so no column depends
+# on the first row, and keys missing from legacy rows are stored as null.
+ACTIVITY_SCHEMA = pa.schema([
+    ('sport', pa.string()),
+    ('start_time', pa.string()),
+    ('duration', pa.int64()),
+    ('distance', pa.float64()),
+    ('calories', pa.int64()),
+    ('avg_hr', pa.int64()),
+    ('max_hr', pa.int64()),
+    ('avg_power', pa.int64()),
+    ('max_power', pa.int64()),
+    ('normalized_power', pa.int64()),
+    ('tss', pa.float64()),
+    ('elevation_gain', pa.int64()),
+    ('avg_cadence', pa.int64()),
+    ('avg_speed', pa.float64()),
+    ('tssType', pa.string()),
+    ('IF', pa.float64()),
+    ('id', pa.string()),
+]) if pa is not None else None
 
 
 def extract_fit_from_zip(zip_path):
-    """Extract .fit file from a zip archive."""
+    """
+    Extract .fit file from a zip archive.
+    The member is inflated straight from the ZIP stream in one read of its
+    declared size; iter_fit_messages then works on the buffer by offset.
+    """
     try:
         with zipfile.ZipFile(zip_path, 'r') as z:
-            for name in z.namelist():
-                if name.lower().endswith('.fit'):
-                    return z.read(name)
+            for info in z.infolist():
+                if info.filename.lower().endswith('.fit'):
+                    with z.open(info) as f:
+                        return f.read(info.file_size)
     except Exception as e:
         print(f"   ⚠️ Error extracting {zip_path}: {e}")
     return None
 
 
+def iter_fit_messages(data):
+    """
+    Walk the FIT file (chained files included) and yield (global message number,
+    fields, values) for session and record messages. fields holds the decoded
+    (field number, invalid value) pairs in definition order and values their raw
+    values; every other message is skipped by its definition size.
+    CRCs are not checked.
+    """
+    offset = 0
+    while offset < len(data):
+        header_size = data[offset]
+        if data[offset + 8:offset + 12] != b'.FIT':
+            raise ValueError("Invalid .FIT File Header")
+        if 12 < header_size < 14:
+            raise ValueError(f"Irregular File Header Size: {header_size}")
+        end = offset + max(header_size, 12) + struct.unpack_from('<I', data, offset + 4)[0]
+        offset += max(header_size, 12)
+
+        # Local message type -> (global number, unpack, fields, size)
+        definitions = {}
+        while offset < end:
+            header = data[offset]
+            offset += 1
+            if header & 0x80:
+                # Compressed timestamp header: always a data message
+                local_type = (header >> 5) & 0x3
+            else:
+                local_type = header & 0xF
+                if header & 0x40:
+                    endian = '>' if data[offset + 1] else '<'
+                    global_num, num_fields = struct.unpack_from(endian + 'HB', data, offset + 2)
+                    offset += 5
+                    wanted = FIT_FIELDS.get(global_num, ())
+                    fmt = endian
+                    fields = []
+                    size = 0
+                    for _ in range(num_fields):
+                        field_num, field_size, base_type = data[offset:offset + 3]
+                        offset += 3
+                        char, base_size, invalid = FIT_BASE_TYPES.get(base_type, ('B', 1, None))
+                        if field_size % base_size:
+                            raise ValueError(f"Invalid field size {field_size} for base type {base_type:#x}")
+                        if field_num in wanted:
+                            if field_size != base_size or base_type not in FIT_BASE_TYPES:
+                                raise ValueError(f"Unsupported array field {field_num} in message {global_num}")
+                            fmt += char
+                            fields.append((field_num, invalid))
+                        else:
+                            fmt += f'{field_size}x'
+                        size += field_size
+                    if header & 0x20:
+                        # Developer fields: (number, size, developer index)
+                        num_dev_fields = data[offset]
+                        offset += 1
+                        for _ in range(num_dev_fields):
+                            size += data[offset + 1]
+                            offset += 3
+                    unpack = struct.Struct(fmt).unpack_from if fields else None
+                    definitions[local_type] = (global_num, unpack, tuple(fields), size)
+                    continue
+
+            definition = definitions.get(local_type)
+            if definition is None:
+                raise ValueError(f"Got data message with invalid local message type {local_type}")
+            global_num, unpack, fields, size = definition
+            if offset + size > len(data):
+                raise ValueError("Tried to read past end of FIT file")
+            if unpack:
+                yield global_num, fields, unpack(data, offset)
+            offset += size
+
+        # File CRC, then possibly a chained FIT file
+        if offset + 2 > len(data):
+            raise ValueError("Tried to read past end of FIT file")
+        offset += 2
+
+
 def parse_fit_file(fit_data):
     """Parse FIT file and extract key metrics."""
     try:
-        fitfile = FitFile(fit_data)
-        
         activity = {
             'sport': None,
             'start_time': None,
@@ -56,75 +261,61 @@ def parse_fit_file(fit_data):
             'avg_speed': None,
         }
         
-        hr_values = []
-        power_values = []
-        cadence_values = []
+        # Typed buffers: the FIT profile stores these as uint8/uint16
+        hr_values = array.array('H')
+        power_values = array.array('H')
+        cadence_values = array.array('H')
         
-        for record in fitfile.get_messages():
-            if record.name == 'session':
-                for field in record.fields:
-                    if field.name == 'sport':
-                        activity['sport'] = get_sport_label(field.value)
-                    elif field.name == 'start_time':
-                        activity['start_time'] = field.value.isoformat() if field.value else None
-                    elif field.name == 'total_elapsed_time':
-                        activity['duration'] = int(field.value) if field.value else 0
-                    elif field.name == 'total_distance':
-                        activity['distance'] = round(field.value / 1000, 2) if field.value else 0
-                    elif field.name == 'total_calories':
-                        activity['calories'] = int(field.value) if field.value else 0
-                    elif field.name == 'avg_heart_rate':
-                        activity['avg_hr'] = int(field.value) if field.value else None
-                    elif field.name == 'max_heart_rate':
-                        activity['max_hr'] = int(field.value) if field.value else None
-                    elif field.name == 'avg_power':
-                        activity['avg_power'] = int(field.value) if field.value else None
-                    elif field.name == 'max_power':
-                        activity['max_power'] = int(field.value) if field.value else None
-                    elif field.name == 'normalized_power':
-                        activity['normalized_power'] = int(field.value) if field.value else None
-                    elif field.name == 'total_ascent':
-                        activity['elevation_gain'] = int(field.value) if field.value else 0
-                    elif field.name == 'avg_cadence':
-                        activity['avg_cadence'] = int(field.value) if field.value else None
-                    elif field.name == 'enhanced_avg_speed' or field.name == 'avg_speed':
-                        activity['avg_speed'] = float(field.value) if field.value else None
-                    elif field.name == 'training_stress_score':
-                        # Valid TSS from device usually preferred, but user reported issues.
-                        # Using our formula for consistency unless 0.
-                        val = field.value
-                        activity['tss'] = round(val, 1) if val and val > 10 else None
-            
+        samples = {3: hr_values, 4: cadence_values, 7: power_values}
+
+        for global_num, fields, values in iter_fit_messages(fit_data):
             # Collect record data for calculations
-            elif record.name == 'record':
-                for field in record.fields:
-                    if field.name == 'heart_rate' and field.value:
-                        hr_values.append(field.value)
-                    elif field.name == 'power' and field.value:
-                        power_values.append(field.value)
-                    elif field.name == 'cadence' and field.value:
-                        cadence_values.append(field.value)
+            if global_num == FIT_RECORD:
+                for (field_num, invalid), value in zip(fields, values):
+                    if value and value != invalid and value == value:
+                        samples[field_num].append(value)
+                continue
+
+            session = {field_num: None if value == invalid or value != value else value
+                       for (field_num, invalid), value in zip(fields, values)}
+            sport = None
+            if FIT_SESSION_SPORT in session:
+                sport = session[FIT_SESSION_SPORT]
+                activity['sport'] = get_sport_label(FIT_SPORTS.get(sport, sport))
+            for field_num, value in session.items():
+                handler = SESSION_FIELDS.get(field_num)
+                if handler is None or (field_num == FIT_SESSION_CADENCE and sport == FIT_SPORT_RUNNING):
+                    continue
+                key, convert = handler
+                activity[key] = convert(value)
         
         # Calculate averages if not in session
-        if not activity['avg_hr'] and hr_values:
-            activity['avg_hr'] = int(sum(hr_values) / len(hr_values))
-        if not activity['max_hr'] and hr_values:
-            activity['max_hr'] = max(hr_values)
-        if not activity['avg_power'] and power_values:
-            activity['avg_power'] = int(sum(power_values) / len(power_values))
-        if not activity['max_power'] and power_values:
-            activity['max_power'] = max(power_values)
-        if not activity['avg_cadence'] and cadence_values:
-            activity['avg_cadence'] = int(sum(cadence_values) / len(cadence_values))
+        hr = np.frombuffer(hr_values, dtype=np.uint16)
+        power = np.frombuffer(power_values, dtype=np.uint16)
+        cadence = np.frombuffer(cadence_values, dtype=np.uint16)
+        if not activity['avg_hr'] and hr.size:
+            activity['avg_hr'] = int(hr.mean())
+        if not activity['max_hr'] and hr.size:
+            activity['max_hr'] = int(hr.max())
+        if not activity['avg_power'] and power.size:
+            activity['avg_power'] = int(power.mean())
+        if not activity['max_power'] and power.size:
+            activity['max_power'] = int(power.max())
+        if not activity['avg_cadence'] and cadence.size:
+            activity['avg_cadence'] = int(cadence.mean())
             
         # Backfill avg_speed if missing (m/s)
         if not activity['avg_speed'] and activity['distance'] and activity['duration']:
             # distance is in km, convert to meters for m/s
             activity['avg_speed'] = (activity['distance'] * 1000) / activity['duration']
         
-        # Estimate TSS if not provided
+        # Device TSS, or None until estimate_tss fills it in for the whole batch
         if not activity['tss'] and activity['duration']:
-            activity['tss'] = estimate_tss(activity)
+            activity['tssType'] = None
+        else:
+            activity['tssType'] = 'TSS'
+        
+        activity['IF'] = intensity_factor(activity)
         
         return activity
         
@@ -168,89 +359,133 @@ def parse_pace_to_speed(pace_str, dist_unit_meters=1000):
     except:
         return 0
 
+def match_sport_label(raw):
+    """Translate a lowercase sport name by exact or substring match."""
+    if raw in SPORT_MAPPING: return SPORT_MAPPING[raw]
+    for key, label in SPORT_MAPPING.items():
+        if key in raw: return label
+    return 'Altro'
+
+# Every FIT sport name resolved once, so known sports are a single lookup
+SPORT_LOOKUP = {name: match_sport_label(name) for name in FIT_SPORTS.values()}
+
+@lru_cache(maxsize=64)
 def get_sport_label(sport_raw):
     """Normalize and translate sport label."""
     if not sport_raw:
         return 'Altro'
     
     raw = str(sport_raw).lower()
-    if raw in SPORT_MAPPING: return SPORT_MAPPING[raw]
-    for key, label in SPORT_MAPPING.items():
-        if key in raw: return label
-    return 'Altro'
+    label = SPORT_LOOKUP.get(raw)
+    return label if label else match_sport_label(raw)
 
-def estimate_tss(activity):
+def intensity_factor(activity):
+    """IF for the web app: NP (or average power) over the sport's FTP."""
+    if not activity.get('avg_power'):
+        return None
+    sport_key = (activity.get('sport') or '').lower()
+    ftp = USER_RUNNING_FTP if 'corsa' in sport_key else USER_CYCLING_FTP
+    return round((activity.get('normalized_power') or activity['avg_power']) / ftp, 2)
+
+def sport_mask(sports, *keys):
+    """Boolean array: which lowercase sport labels contain any of keys."""
+    return np.array([any(key in sport for key in keys) for sport in sports], dtype=bool)
+
+def estimate_tss(activities):
     """
-    Estimate TSS matching TrainingPeaks logic.
+    Estimate TSS matching TrainingPeaks logic, for a batch of activities.
     Priority:
     1. Swimming -> sTSS (Speed)
     2. Running -> rTSS (Pace) - TP prioritizes rTSS over Power usually
     3. Cycling -> TSS (Power)
     4. HR Fallback -> hrTSS
+    5. Duration fallback
+    Every formula is evaluated over the whole batch as NumPy columns and
+    np.select picks the first applicable one; sets 'tss' and 'tssType'.
     """
-    duration_seconds = activity['duration']
+    if not activities:
+        return
+    
+    sports = [(a['sport'] or '').lower() for a in activities]
+    duration_seconds = np.array([a['duration'] for a in activities], dtype=float)
     duration_hours = duration_seconds / 3600
-    sport = (activity['sport'] or '').lower()
+    # avg_speed is already backfilled from distance/duration by parse_fit_file
+    avg_speed = np.array([a.get('avg_speed') or 0 for a in activities], dtype=float)
+    power = np.array([a['normalized_power'] or a['avg_power'] or 0 for a in activities], dtype=float)
+    avg_hr = np.array([a['avg_hr'] or 0 for a in activities], dtype=float)
+    
+    swimming = sport_mask(sports, 'nuoto', 'swimming')
+    running = sport_mask(sports, 'corsa', 'running')
+    walking = sport_mask(sports, 'camminata', 'walking')
+    cycling = sport_mask(sports, 'ciclismo', 'cycling')
     
     # 1. SWIMMING (sTSS)
-    if 'nuoto' in sport or 'swimming' in sport:
-        thresh_speed = parse_pace_to_speed(USER_SWIM_THRESHOLD_PACE, 100)
-        # print(f"DEBUG: Swim Threshold Pace: {USER_SWIM_THRESHOLD_PACE}, Speed: {thresh_speed}")
-        avg_speed = activity.get('avg_speed', 0)
-        
-        # Recalculate speed from dist/time if missing (often more accurate using total time)
-        if not avg_speed and activity['distance'] and activity['duration']:
-             # Use * 1000 because activity distance is km
-            avg_speed = (activity['distance'] * 1000) / activity['duration']
-            
-        if avg_speed and thresh_speed > 0:
-            intensity_factor = avg_speed / thresh_speed
-            stss = (intensity_factor ** 3) * duration_hours * 100
-            activity['tssType'] = 'sTSS'
-            return round(min(stss, 600), 1)
-
+    swim_speed = parse_pace_to_speed(USER_SWIM_THRESHOLD_PACE, 100)
+    swim_if = avg_speed / swim_speed if swim_speed > 0 else np.zeros_like(avg_speed)
+    stss = (swim_if ** 3) * duration_hours * 100
+    
     # 2. RUNNING & WALKING (rTSS) - Prioritize Pace over Power for TP alignment
-    if 'corsa' in sport or 'running' in sport or 'camminata' in sport or 'walking' in sport:
-        thresh_speed = parse_pace_to_speed(USER_RUN_THRESHOLD_PACE, 1000)
-        avg_speed = activity.get('avg_speed', 0)
-        
-        if not avg_speed and activity['distance'] and activity['duration']:
-            avg_speed = (activity['distance'] * 1000) / activity['duration']
-            
-        if avg_speed and thresh_speed > 0:
-            intensity_factor = avg_speed / thresh_speed
-            rtss = (intensity_factor ** 2) * duration_hours * 100
-            activity['tssType'] = 'rTSS' # Mark as rTSS
-            return round(min(rtss, 600), 1)
-
+    run_speed = parse_pace_to_speed(USER_RUN_THRESHOLD_PACE, 1000)
+    run_if = avg_speed / run_speed if run_speed > 0 else np.zeros_like(avg_speed)
+    rtss = (run_if ** 2) * duration_hours * 100
+    
     # 3. CYCLING (TSS - Power)
-    if (activity['normalized_power'] or activity['avg_power']) and ('nuoto' not in sport):
-        np = activity['normalized_power'] or activity['avg_power']
-        ftp = USER_CYCLING_FTP
-        # Running fallback to power if rTSS failed? (Already handled above)
-        
-        intensity_factor = np / ftp
-        tss = (duration_seconds * np * intensity_factor) / (ftp * 3600) * 100
-        activity['tssType'] = 'TSS'
-        return round(min(tss, 600), 1)
-
+    ftp = USER_CYCLING_FTP
+    power_if = power / ftp
+    power_tss = (duration_seconds * power * power_if) / (ftp * 3600) * 100
+    
     # 4. HR-BASED CALCULATION (hrTSS)
-    if activity['avg_hr']:
-        hr_ratio = activity['avg_hr'] / USER_LTHR
-        tss = duration_hours * (hr_ratio * hr_ratio) * 100
-        activity['tssType'] = 'hrTSS'
-        return round(min(tss, 600), 1)
+    hr_ratio = avg_hr / USER_LTHR
+    hrtss = duration_hours * (hr_ratio * hr_ratio) * 100
     
     # 5. DURATION FALLBACK
-    activity['tssType'] = 'Time'
-    if 'corsa' in sport or 'running' in sport:
-        return round(duration_hours * 60, 1)
-    elif 'ciclismo' in sport or 'cycling' in sport:
-        return round(duration_hours * 50, 1)
-    elif 'nuoto' in sport or 'swimming' in sport:
-        return round(duration_hours * 45, 1)
-    
-    return round(duration_hours * 40, 1)
+    time_tss = np.select([running, cycling, swimming],
+                         [duration_hours * 60, duration_hours * 50, duration_hours * 45],
+                         default=duration_hours * 40)
+    
+    conditions = [
+        swimming & (avg_speed != 0) & (swim_speed > 0),
+        (running | walking) & (avg_speed != 0) & (run_speed > 0),
+        (power != 0) & ~sport_mask(sports, 'nuoto'),
+        avg_hr != 0,
+    ]
+    formulas = (stss, rtss, power_tss, hrtss)
+    # Formula results are capped at 600
+    tss = np.select(conditions, [np.minimum(t, 600) for t in formulas], default=time_tss)
+    tss_types = np.select(conditions, ['sTSS', 'rTSS', 'TSS', 'hrTSS'], default='Time')
+    
+    for activity, value, tss_type in zip(activities, tss.tolist(), tss_types.tolist()):
+        activity['tss'] = round(value, 1)
+        activity['tssType'] = tss_type
+
+
+def process_one(job):
+    """Extract and parse one activity ZIP (top-level so Pool can pickle it)."""
+    i, zip_path = job
+    fit_data = extract_fit_from_zip(zip_path)
+    if not fit_data:
+        return i, None
+    
+    activity = parse_fit_file(fit_data)
+    if activity:
+        activity['id'] = zip_path.stem
+    return i, activity
+
+
+def exponential_average(values, decay):
+    """
+    Exponential moving average starting from 0: avg = avg * (1 - decay) + value * decay.
+    lfilter evaluates the same recurrence as a first-order IIR filter.
+    """
+    if lfilter is not None:
+        return lfilter([decay], [1.0, -(1.0 - decay)], values).tolist()
+    
+    averages = []
+    avg = 0
+    for value in values:
+        avg = avg * (1 - decay) + value * decay
+        averages.append(avg)
+    return averages
 
 
 def calculate_performance_metrics(activities):
@@ -264,44 +499,52 @@ def calculate_performance_metrics(activities):
     if not sorted_activities:
         return {'ctl': 0, 'atl': 0, 'tsb': 0, 'daily_tss': {}}
     
-    # Aggregate TSS by day
-    daily_tss = defaultdict(float)
-    for act in sorted_activities:
-        try:
-            date = act['start_time'][:10]
-            daily_tss[date] += act.get('tss', 0) or 0
-        except:
-            continue
+    if pd is not None:
+        # Aggregate TSS by day (ISO day strings sort chronologically), then
+        # fill in missing dates with 0
+        tss = pd.Series([act.get('tss', 0) or 0 for act in sorted_activities],
+                        index=[act['start_time'][:10] for act in sorted_activities], dtype=float)
+        daily = tss.groupby(level=0).sum()
+        daily_tss = dict(zip(daily.index, daily.tolist()))
+        all_dates = pd.date_range(daily.index[0], daily.index[-1]).strftime('%Y-%m-%d').tolist()
+        tss_series = daily.reindex(all_dates, fill_value=0.0).to_numpy()
+    else:
+        # Aggregate TSS by day
+        daily_tss = defaultdict(float)
+        for act in sorted_activities:
+            try:
+                date = act['start_time'][:10]
+                daily_tss[date] += act.get('tss', 0) or 0
+            except:
+                continue
+        
+        dates = sorted(daily_tss.keys())
+        if not dates:
+            return {'ctl': 0, 'atl': 0, 'tsb': 0, 'daily_tss': {}}
+        
+        # Fill in missing dates
+        start = datetime.fromisoformat(dates[0])
+        end = datetime.fromisoformat(dates[-1])
+        all_dates = []
+        current = start
+        while current <= end:
+            all_dates.append(current.strftime('%Y-%m-%d'))
+            current += timedelta(days=1)
+        
+        tss_series = [daily_tss.get(date, 0) for date in all_dates]
     
     # Calculate CTL (42-day) and ATL (7-day) exponential averages
-    dates = sorted(daily_tss.keys())
-    if not dates:
-        return {'ctl': 0, 'atl': 0, 'tsb': 0, 'daily_tss': {}}
-    
-    # Fill in missing dates
-    start = datetime.fromisoformat(dates[0])
-    end = datetime.fromisoformat(dates[-1])
-    all_dates = []
-    current = start
-    while current <= end:
-        all_dates.append(current.strftime('%Y-%m-%d'))
-        current += timedelta(days=1)
+    ctl_decay = 2 / (42 + 1)  # Chronic Training Load (42-day)
+    atl_decay = 2 / (7 + 1)   # Acute Training Load (7-day)
     
-    # Calculate exponential moving averages
-    ctl = 0  # Chronic Training Load (42-day)
-    atl = 0  # Acute Training Load (7-day)
+    ctl_series = exponential_average(tss_series, ctl_decay)
+    atl_series = exponential_average(tss_series, atl_decay)
     
-    ctl_decay = 2 / (42 + 1)
-    atl_decay = 2 / (7 + 1)
-    
-    ctl_history = []
-    atl_history = []
-    
-    for date in all_dates:
-        tss = daily_tss.get(date, 0)
-        ctl = ctl * (1 - ctl_decay) + tss * ctl_decay
-        atl = atl * (1 - atl_decay) + tss * atl_decay
-        ctl_history.append({'date': date, 'ctl': round(ctl, 1), 'atl': round(atl, 1), 'tsb': round(ctl - atl, 1)})
+    # Only the last 90 days are exported: build history entries just for those
+    ctl_history = [
+        {'date': date, 'ctl': round(ctl, 1), 'atl': round(atl, 1), 'tsb': round(ctl - atl, 1)}
+        for date, ctl, atl in zip(all_dates[-90:], ctl_series[-90:], atl_series[-90:])
+    ]
     
     # Return latest values
     latest = ctl_history[-1] if ctl_history else {'ctl': 0, 'atl': 0, 'tsb': 0}
@@ -315,12 +558,47 @@ def calculate_performance_metrics(activities):
     }
 
 
+def write_json(path, obj, compact=False):
+    """Write obj as indented JSON, or without whitespace when compact."""
+    if orjson:
+        option = orjson.OPT_SERIALIZE_NUMPY | (0 if compact else orjson.OPT_INDENT_2)
+        path.write_bytes(orjson.dumps(obj, default=str, option=option))
+    elif compact:
+        with open(path, 'w') as f:
+            json.dump(obj, f, separators=(',', ':'), default=str)
+    else:
+        with open(path, 'w') as f:
+            json.dump(obj, f, indent=2, default=str)
+
+
+def load_existing_activities(cache_file, output_file):
+    """Load previously processed activities keyed by id."""
+    if pa is not None and cache_file.exists():
+        try:
+            return {a['id']: a for a in pq.read_table(cache_file).to_pylist()}
+        except:
+            pass
+    if output_file.exists():
+        try:
+            if orjson:
+                existing = orjson.loads(output_file.read_bytes())
+            else:
+                with open(output_file, 'r') as f:
+                    existing = json.load(f)
+            return {a['id']: a for a in existing.get('activities', [])}
+        except:
+            pass
+    return {}
+
+
 def main():
     """Main processing function."""
     print("🏃 Processing FIT files...")
     
     activities_dir = Path("data/activities")
     output_file = Path("data/workouts.json")
+    cache_file = Path("data/workouts.parquet")
+    stat_cache_file = Path("data/.fit_cache.pkl")
     
     if not activities_dir.exists():
         print("❌ No activities directory found")
@@ -333,50 +611,84 @@ def main():
         print("⚠️ No ZIP files to process")
         return True
     
-    # Load existing data if available
-    existing_data = {}
-    if output_file.exists():
+    # Local stat cache {id: (mtime_ns, size, activity)}: unchanged archives are
+    # reused without opening the ZIP, changed ones are parsed again
+    stat_cache = {}
+    if stat_cache_file.exists():
         try:
-            with open(output_file, 'r') as f:
-                existing = json.load(f)
-                existing_data = {a['id']: a for a in existing.get('activities', [])}
+            with open(stat_cache_file, 'rb') as f:
+                stat_cache = pickle.load(f)
         except:
             pass
     
-    activities = []
+    # One slot per ZIP: results arrive out of order but keep the directory order
+    slots = [None] * len(zip_files)
+    stats = [None] * len(zip_files)
     processed = 0
     skipped = 0
     errors = 0
     
+    pending = []
     for i, zip_path in enumerate(zip_files):
-        activity_id = zip_path.stem
-        
+        st = zip_path.stat()
+        stats[i] = (st.st_mtime_ns, st.st_size)
+        cached = stat_cache.get(zip_path.stem)
+        if cached and cached[:2] == stats[i]:
+            slots[i] = cached[2]
+            # Cached before IF was stored on the activity
+            if 'IF' not in slots[i]:
+                slots[i]['IF'] = intensity_factor(slots[i])
+            skipped += 1
+        else:
+            pending.append((i, zip_path, cached))
+    
+    # Load existing data only for archives missing from the stat cache (e.g. a
+    # fresh checkout): the Parquet cache holds every activity, workouts.json
+    # only the last 100
+    existing_data = {}
+    if any(cached is None for _, _, cached in pending):
+        existing_data = load_existing_activities(cache_file, output_file)
+    
+    jobs = []
+    unestimated = []
+    for i, zip_path, cached in pending:
         # Skip if already processed
-        if activity_id in existing_data:
-            activities.append(existing_data[activity_id])
+        if cached is None and zip_path.stem in existing_data:
+            slots[i] = existing_data[zip_path.stem]
+            if 'IF' not in slots[i]:
+                slots[i]['IF'] = intensity_factor(slots[i])
             skipped += 1
-            continue
-        
-        if (i + 1) % 50 == 0:
-            print(f"   Processing {i+1}/{len(zip_files)}...")
-        
-        fit_data = extract_fit_from_zip(zip_path)
-        if not fit_data:
-            errors += 1
-            continue
-        
-        activity = parse_fit_file(fit_data)
-        if activity:
-            activity['id'] = activity_id
-            activities.append(activity)
-            processed += 1
         else:
-            errors += 1
+            jobs.append((i, zip_path))
+    
+    # Files are independent: inflate and parse them across all cores
+    if jobs:
+        chunksize = max(1, len(jobs) // ((os.cpu_count() or 1) * 4))
+        with Pool() as pool:
+            for done, (i, activity) in enumerate(pool.imap_unordered(process_one, jobs, chunksize=chunksize), 1):
+                if done % 50 == 0:
+                    print(f"   Processing {done}/{len(jobs)}...")
+                
+                if activity:
+                    slots[i] = activity
+                    processed += 1
+                    if activity['tssType'] is None:
+                        unestimated.append(activity)
+                else:
+                    errors += 1
+    
+    # Estimate TSS for all new activities at once
+    estimate_tss(unestimated)
+    
+    activities = [activity for activity in slots if activity]
     
     # Calculate performance metrics
     print("📊 Calculating performance metrics...")
     perf = calculate_performance_metrics(activities)
     
+    # Newest first, shared by both exports (activities without a start time go last)
+    activities_sorted = sorted(activities, key=lambda x: x['start_time'] or '', reverse=True)
+    
     # Prepare output
     output = {
         'last_updated': datetime.now().isoformat(),
@@ -389,18 +701,28 @@ def main():
         },
         'history': perf.get('history', []),
         'daily_tss': perf.get('daily_tss', {}),
-        'activities': sorted(activities, key=lambda x: x.get('start_time', ''), reverse=True)[:100]  # Last 100
+        'activities': activities_sorted[:100]  # Last 100
     }
     
     # Save output
-    with open(output_file, 'w') as f:
-        json.dump(output, f, indent=2, default=str)
+    write_json(output_file, output)
+    
+    if pa is not None:
+        pq.write_table(pa.Table.from_pylist(activities, schema=ACTIVITY_SCHEMA), cache_file, compression='zstd')
+    
+    # Write to a temp file first so an interrupted run never leaves a torn cache
+    stat_cache = {zip_path.stem: (*stat, activity)
+                  for zip_path, stat, activity in zip(zip_files, stats, slots) if activity}
+    tmp_file = stat_cache_file.with_suffix('.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(stat_cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, stat_cache_file)
     
     # Also generate activities.json in the format the web app expects (camelCase keys)
     activities_output_file = Path("data/activities.json")
-    web_activities = []
-    for act in activities:
-        web_act = {
+    # Already in date descending order (IF comes from parsing)
+    web_activities_sorted = [
+        {
             'id': act.get('id'),
             'sport': act.get('sport'),
             'startTime': act.get('start_time'),
@@ -413,24 +735,13 @@ def main():
             'avgSpeed': act.get('avg_speed'),
             'calories': act.get('calories'),
             'laps': [],
-            'laps': [],
             'tss': act.get('tss'),
-            'tssType': act.get('tssType', 'TSS'),
-            # IF calculated later based on sport
-            'IF': None,
+            'tssType': act.get('tssType') or 'TSS',
+            'IF': act.get('IF'),
             'filename': f"{act.get('id')}.fit"
         }
-        web_activities.append(web_act)
-    
-    # Sort by date descending
-    web_activities_sorted = sorted(web_activities, key=lambda x: x.get('startTime') or '', reverse=True)
-    
-    # Update IF calculation logic for export
-    for act in web_activities_sorted:
-        if act.get('avgPower'):
-            sport_key = (act.get('sport') or '').lower()
-            ftp = USER_RUNNING_FTP if 'corsa' in sport_key else USER_CYCLING_FTP
-            act['IF'] = round((act.get('normalizedPower') or act.get('avgPower')) / ftp, 2)
+        for act in activities_sorted
+    ]
     
     activities_output = {
         'exportDate': datetime.now().isoformat(),
@@ -438,8 +749,8 @@ def main():
         'activities': web_activities_sorted
     }
     
-    with open(activities_output_file, 'w') as f:
-        json.dump(activities_output, f, indent=2, default=str)
+    # Compact: this file holds every activity
+    write_json(activities_output_file, activities_output, compact=True)
     
     print(f"📱 Generated activities.json with {len(web_activities_sorted)} activities for web app")
     
@@ -56,78 +56,99 @@ def load_excel_data(file_path):
     df = df_raw.groupby('ActivityID').first().reset_index()
     return df, df_raw
 
-def calculate_sport_tss(row, ftp_bike, ftp_run, ftp_swim, lthr):
+def make_sport_tss(columns, ftp_bike, ftp_run, ftp_swim, lthr):
     """
-    Calcola TSS sport-specific secondo formule TrainingPeaks:
+    Crea la funzione TSS sport-specific specializzata per un DataFrame:
+    posizioni delle colonne e soglie atleta sono fissate una volta nella closure,
+    la funzione restituita lavora sulle tuple di df.itertuples(index=False, name=None).
+    Formule TrainingPeaks:
     - TSS (ciclismo): (sec × NP × IF) / (FTP × 3600) × 100
     - rTSS (corsa): (sec × NGP × IF) / (FTPace × 3600) × 100, dove IF = NGP/FTPace
     - sTSS (nuoto): IF³ × hours × 100, dove IF = NSS/FTPswim
     """
-    duration_sec = row.get('Attivita_Durata Totale (sec)', 0) or 0
-    duration_h = duration_sec / 3600 if duration_sec > 0 else 0
-    sport = str(row.get('Attivita_Tipo Sport', '')).lower()
+    col_idx = {name: i for i, name in enumerate(columns)}
     
-    # ========== CYCLING con potenza ==========
-    if 'cycl' in sport:
-        np_val = row.get('Attivita_Potenza Normalizzata (W)', 0) or 0
-        if np_val > 0 and ftp_bike > 0:
-            intensity_factor = np_val / ftp_bike
-            # TSS = (sec × NP × IF) / (FTP × 3600) × 100
-            return (duration_sec * np_val * intensity_factor) / (ftp_bike * 3600) * 100
+    def getter(name, default=0):
+        i = col_idx.get(name)
+        if i is None:
+            return lambda values: default
+        return lambda values: values[i]
     
-    # ========== RUNNING con pace ==========
-    if 'run' in sport:
-        vel_ms = row.get('Attivita_Velocità Media (m/s)', 0) or 0
-        dist_km = row.get('Attivita_Distanza (km)', 0) or 0
-        
-        if vel_ms > 0 and dist_km > 0 and ftp_run > 0:
-            # Pace attuale in sec/km
-            pace_sec_km = 1000 / vel_ms
-            # NGP ≈ pace (senza correzione dislivello per semplicità)
-            ngp = pace_sec_km
-            # Intensity Factor = FTP_pace / pace_attuale (nota: più veloce = pace più basso = IF più alto)
-            # TrainingPeaks usa: IF = NGP / FTP dove NGP è in min/km
-            # Più veloce = IF più alto, quindi IF = FTP_pace / pace_attuale
-            intensity_factor = ftp_run / ngp
-            # rTSS formula
-            return (duration_sec * intensity_factor * intensity_factor) / 3600 * 100
-        
-        # Fallback hrTSS se non c'è pace
-        hr = row.get('Attivita_FC Media (bpm)', 0) or 0
+    get_dur = getter('Attivita_Durata Totale (sec)')
+    get_sport = getter('Attivita_Tipo Sport', '')
+    get_np = getter('Attivita_Potenza Normalizzata (W)')
+    get_vel = getter('Attivita_Velocità Media (m/s)')
+    get_dist = getter('Attivita_Distanza (km)')
+    get_hr = getter('Attivita_FC Media (bpm)')
+    
+    def sport_tss(values):
+        duration_sec = get_dur(values) or 0
+        duration_h = duration_sec / 3600 if duration_sec > 0 else 0
+        sport = str(get_sport(values)).lower()
+        
+        # ========== CYCLING con potenza ==========
+        if 'cycl' in sport:
+            np_val = get_np(values) or 0
+            if np_val > 0 and ftp_bike > 0:
+                intensity_factor = np_val / ftp_bike
+                # TSS = (sec × NP × IF) / (FTP × 3600) × 100
+                return (duration_sec * np_val * intensity_factor) / (ftp_bike * 3600) * 100
+        
+        # ========== RUNNING con pace ==========
+        if 'run' in sport:
+            vel_ms = get_vel(values) or 0
+            dist_km = get_dist(values) or 0
+            
+            if vel_ms > 0 and dist_km > 0 and ftp_run > 0:
+                # Pace attuale in sec/km
+                pace_sec_km = 1000 / vel_ms
+                # NGP ≈ pace (senza correzione dislivello per semplicità)
+                ngp = pace_sec_km
+                # Intensity Factor = FTP_pace / pace_attuale (nota: più veloce = pace più basso = IF più alto)
+                # TrainingPeaks usa: IF = NGP / FTP dove NGP è in min/km
+                # Più veloce = IF più alto, quindi IF = FTP_pace / pace_attuale
+                intensity_factor = ftp_run / ngp
+                # rTSS formula
+                return (duration_sec * intensity_factor * intensity_factor) / 3600 * 100
+            
+            # Fallback hrTSS se non c'è pace
+            hr = get_hr(values) or 0
+            if hr > 0 and lthr > 0:
+                hr_ratio = hr / lthr
+                return duration_h * (hr_ratio ** 2) * 100
+            return duration_h * 70  # Stima generica
+        
+        # ========== SWIMMING con pace ==========
+        if 'swim' in sport:
+            vel_ms = get_vel(values) or 0
+            dist_km = get_dist(values) or 0
+            
+            if vel_ms > 0 and dist_km > 0 and ftp_swim > 0:
+                # Pace attuale in sec/100m
+                pace_sec_100m = 100 / vel_ms
+                # NSS = Normalized Swim Speed (usiamo pace medio)
+                nss = pace_sec_100m
+                # IF = FTP_pace / pace_attuale
+                intensity_factor = ftp_swim / nss
+                # sTSS = IF³ × hours × 100
+                return (intensity_factor ** 3) * duration_h * 100
+            
+            # Fallback hrTSS
+            hr = get_hr(values) or 0
+            if hr > 0 and lthr > 0:
+                hr_ratio = hr / lthr
+                return duration_h * (hr_ratio ** 3) * 100
+            return duration_h * 50  # Stima generica nuoto
+        
+        # ========== ALTRI SPORT (hrTSS) ==========
+        hr = get_hr(values) or 0
         if hr > 0 and lthr > 0:
             hr_ratio = hr / lthr
             return duration_h * (hr_ratio ** 2) * 100
-        return duration_h * 70  # Stima generica
-    
-    # ========== SWIMMING con pace ==========
-    if 'swim' in sport:
-        vel_ms = row.get('Attivita_Velocità Media (m/s)', 0) or 0
-        dist_km = row.get('Attivita_Distanza (km)', 0) or 0
         
-        if vel_ms > 0 and dist_km > 0 and ftp_swim > 0:
-            # Pace attuale in sec/100m
-            pace_sec_100m = 100 / vel_ms
-            # NSS = Normalized Swim Speed (usiamo pace medio)
-            nss = pace_sec_100m
-            # IF = FTP_pace / pace_attuale
-            intensity_factor = ftp_swim / nss
-            # sTSS = IF³ × hours × 100
-            return (intensity_factor ** 3) * duration_h * 100
-        
-        # Fallback hrTSS
-        hr = row.get('Attivita_FC Media (bpm)', 0) or 0
-        if hr > 0 and lthr > 0:
-            hr_ratio = hr / lthr
-            return duration_h * (hr_ratio ** 3) * 100
-        return duration_h * 50  # Stima generica nuoto
+        return duration_h * 60  # Fallback generico
     
-    # ========== ALTRI SPORT (hrTSS) ==========
-    hr = row.get('Attivita_FC Media (bpm)', 0) or 0
-    if hr > 0 and lthr > 0:
-        hr_ratio = hr / lthr
-        return duration_h * (hr_ratio ** 2) * 100
-    
-    return duration_h * 60  # Fallback generico
+    return sport_tss
 
 def generate_prompt(df, df_raw, age, ftp_bike, ftp_run, ftp_swim, lthr):
     """Genera il prompt per l'AI Coach"""
@@ -139,15 +160,19 @@ def generate_prompt(df, df_raw, age, ftp_bike, ftp_run, ftp_swim, lthr):
     df['Date'] = df['Date'].dt.normalize()
     
     # Usa TSS nativo Garmin se disponibile, altrimenti calcola
-    def get_tss(row):
+    sport_tss = make_sport_tss(df.columns, ftp_bike, ftp_run, ftp_swim, lthr)
+    native_idx = df.columns.get_loc('Attivita_TSS') if 'Attivita_TSS' in df.columns else None
+    
+    def get_tss(values):
         # Prima prova TSS nativo da Garmin
-        native_tss = row.get('Attivita_TSS', None)
-        if pd.notna(native_tss) and native_tss > 0:
-            return native_tss
+        if native_idx is not None:
+            native_tss = values[native_idx]
+            if pd.notna(native_tss) and native_tss > 0:
+                return native_tss
         # Altrimenti calcola
-        return calculate_sport_tss(row, ftp_bike, ftp_run, ftp_swim, lthr)
+        return sport_tss(values)
     
-    df['TSS'] = df.apply(get_tss, axis=1)
+    df['TSS'] = [get_tss(values) for values in df.itertuples(index=False, name=None)]
     
     # Calcola PMC (CTL, ATL, TSB) - formula TrainingPeaks
     # CTL = CTL_ieri + (TSS_oggi - CTL_ieri) / 42